@@ -1,6 +1,11 @@
 import os
+import atexit
+import copy
+import queue
 from dotenv import load_dotenv
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import orjson
 
 load_dotenv() # Load environment variables from .env file
 
@@ -10,10 +15,46 @@ class Settings:
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./trades.db")
     NIFTY_HISTORICAL_DATA_URL: str = "https://raw.githubusercontent.com/shritish20/VolGuard/main/nifty_50.csv"
     XGBOOST_MODEL_URL: str = "https://drive.google.com/uc?export=download&id=1Gs86p1p8wsGe1lp498KC-OVn0e87Gv-R"
+    UPSTOX_MAX_REQUESTS_PER_SECOND: float = float(os.getenv("UPSTOX_MAX_REQUESTS_PER_SECOND", "25")) # Process-wide outbound pacing
+    UPSTOX_MAX_CONCURRENCY: int = int(os.getenv("UPSTOX_MAX_CONCURRENCY", "20")) # Upstox calls in flight at once
+    HISTORY_CACHE_DIR: str = os.getenv("HISTORY_CACHE_DIR", "/tmp/volguard") # Parquet snapshots of remote history CSVs
 
 # Initialize settings
 settings = Settings()
 
+class JSONFormatter(logging.Formatter):
+    """Renders log records as single-line JSON via orjson."""
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "asctime": self.formatTime(record),
+            "name": record.name,
+            "levelname": record.levelname,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(payload).decode()
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues records with exc_info intact. The stock prepare() formats the record on the calling thread and
+    drops exc_info, which folded tracebacks into "message"; here only the message arguments are merged (so later
+    mutation cannot change them) and the listener's formatter renders everything else."""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
 # Configure Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(JSONFormatter())
 logger = logging.getLogger("VolGuardPro")
+logger.setLevel(logging.INFO)
+# Hand records to a background thread so formatting and stream writes stay off the request path
+_log_queue = queue.SimpleQueue()
+log_listener = QueueListener(_log_queue, console_handler, respect_handler_level=True)
+logger.addHandler(DeferredQueueHandler(_log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
+logger.propagate = False # Records are already emitted as JSON; don't repeat them via the root handler
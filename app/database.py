@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
 from app.models import Base
@@ -6,9 +6,25 @@ from app.models import Base
 # SQLAlchemy Engine
 engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
 
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL lets analytics reads run concurrently with trade inserts; the rest trades durability
+        on power loss (not on crash) for fewer fsyncs and a larger page cache."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA cache_size=-64000") # ~64 MB
+        cursor.execute("PRAGMA mmap_size=268435456") # 256 MB
+        cursor.close()
+
 # SessionLocal for database interactions
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create database tables if they don't exist
 def create_db_and_tables():
     Base.metadata.create_all(bind=engine)
+    # create_all skips indexes on tables that already exist; add any missing ones
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
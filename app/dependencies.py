@@ -1,4 +1,6 @@
-from app.database import SessionLocal
+from fastapi import Request
+import httpx
+from app.database import SessionLocal, engine
 from sqlalchemy.orm import Session
 
 def get_db():
@@ -8,3 +10,22 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def get_db_readonly():
+    """Dependency to get a lightweight Core connection for read-only queries (no ORM session)."""
+    with engine.connect() as conn:
+        yield conn.execution_options(yield_per=1000)
+
+def create_http_client() -> httpx.AsyncClient:
+    """Builds the app-wide keep-alive HTTP/2 client, so every outbound Upstox call reuses one TCP+TLS pool."""
+    # HTTP/2 multiplexes the concurrent depth/P&L bursts over a single connection per host; the limits
+    # only bound the fallback when the server speaks HTTP/1.1
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=10,
+    )
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Dependency to get the shared, connection-pooled async HTTP client."""
+    return request.app.state.http
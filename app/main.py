@@ -1,6 +1,14 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+import asyncio
+import anyio
+from concurrent.futures import ThreadPoolExecutor
 from app.config import settings, logger
 from app.database import create_db_and_tables
+from app.dependencies import create_http_client
+from app.utils.kernels import warm_kernels
+from app.utils.upstox_helpers import close_upstox_api_clients
 
 # Import routers
 from app.routers import market_data, strategy, volatility, user_management, analytics
@@ -8,9 +16,14 @@ from app.routers import market_data, strategy, volatility, user_management, anal
 app = FastAPI(
     title="VolGuard Pro Backend API",
     description="API for fetching market data, volatility forecasting, and trade execution.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+# Option-chain payloads run to hundreds of KB of JSON; compress anything non-trivial. Level 5 gets nearly
+# all of level 9's ratio on repetitive JSON at a fraction of the CPU per poll.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
 # Include routers
 app.include_router(market_data.router, prefix="/market-data", tags=["Market Data"])
 app.include_router(strategy.router, prefix="/strategy", tags=["Strategy & Backtesting"])
@@ -25,6 +38,20 @@ async def startup_event():
     logger.info("FastAPI app starting up...")
     create_db_and_tables() # Ensure database tables are created
     logger.info("Database tables checked/created.")
+    # asyncio.to_thread runs blocking Upstox SDK/requests calls here; size it for bursts of concurrent legs
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=32, thread_name_prefix="upstox"))
+    # Plain `def` routes run on anyio's separate 40-token pool; the volatility routes can block there on a cold
+    # model/history download, so leave headroom for the DB and compute routes queued behind them
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 100
+    warm_kernels() # Compile numerical kernels up front instead of on the first request
+    app.state.http = create_http_client()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Actions to perform on application shutdown."""
+    await app.state.http.aclose()
+    close_upstox_api_clients()
+    logger.info("FastAPI app shut down.")
 
 @app.get("/", tags=["Root"])
 def root():
@@ -35,9 +62,9 @@ def root():
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc: HTTPException):
     logger.error(f"HTTP Exception: {exc.status_code} - {exc.detail}")
-    return HTTPException(status_code=exc.status_code, detail=exc.detail)
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
 
 @app.exception_handler(Exception)
 async def generic_exception_handler(request, exc: Exception):
     logger.exception(f"Unhandled Exception: {exc}")
-    return HTTPException(status_code=500, detail="Internal Server Error")
+    return ORJSONResponse({"detail": "Internal Server Error"}, status_code=500)
@@ -1,6 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index
 from sqlalchemy.orm import declarative_base
 
 # SQLAlchemy Base for database models
@@ -17,6 +17,9 @@ class Trade(Base):
     regime_score = Column(Float)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+    # Covering index for the analytics/discipline aggregates (index-only scans)
+    __table_args__ = (Index("ix_trades_ts_pnl_regime", "timestamp", "pnl", "regime_score"),)
+
 # --- Pydantic Models for API Requests/Responses ---
 
 class XGBInput(BaseModel):
@@ -54,6 +57,8 @@ class RiskCheckInput(BaseModel):
     iv_rv_ratio: float
 
 class RegimeInput(BaseModel):
+    model_config = ConfigDict(frozen=True) # Hashable, so regime scores can be cached by input
+
     ivp: float
     pcr: float
     vix: float
@@ -65,6 +70,7 @@ class RegimeInput(BaseModel):
 class OptionChainInput(BaseModel):
     access_token: str
     instrument_key: str = "NSE_INDEX|Nifty 50"
+    include_raw: bool = False # Also return the raw Upstox chain under "data"
 
 class MarketDepthInput(BaseModel):
     access_token: str
@@ -76,7 +82,7 @@ class StrategyExecuteInput(BaseModel):
     spot_price: float
     quantity: int
     otm_distance: float
-    option_chain: dict # This should contain the 'data' and 'iv_skew_data' from the /option-chain response
+    option_chain: dict # The /option-chain response: its 'iv_skew_data', or the raw 'data' when fetched with include_raw
 
 class UserDetailsInput(BaseModel):
     access_token: str
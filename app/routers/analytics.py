@@ -1,12 +1,53 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+from threading import Lock
+import numpy as np
+from cachetools import TTLCache, cached
+from sqlalchemy import select, func, case
+from sqlalchemy import Connection
 from sqlalchemy.orm import Session
 from app.config import logger
 from app.models import TradeInput, RegimeInput, RiskCheckInput, Trade
-from app.dependencies import get_db
-from app.utils.risk_management import calculate_discipline_score
+from app.dependencies import get_db, get_db_readonly
+from app.utils.risk_management import calculate_discipline_score, check_risk_batch
 
 router = APIRouter()
 
+_trades = Trade.__table__
+
+# Pre-built validators for the hot pure-compute endpoints: pydantic-core parses the raw JSON body
+# directly instead of FastAPI decoding it to a dict first.
+_RiskCheckAdapter = TypeAdapter(RiskCheckInput)
+_RiskCheckBatchAdapter = TypeAdapter(list[RiskCheckInput])
+_RegimeAdapter = TypeAdapter(RegimeInput)
+
+def _json_body(adapter: TypeAdapter) -> dict:
+    """OpenAPI request-body spec for a route that validates its body with a TypeAdapter."""
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": adapter.json_schema()}}}}
+
+async def _validate_body(request: Request, adapter: TypeAdapter):
+    """Validates the raw request body, surfacing errors as FastAPI's usual 422 response."""
+    try:
+        return adapter.validate_json(await request.body())
+    except ValidationError as e:
+        # Same shape as FastAPI's own body errors: no docs URL, locations rooted at "body"
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
+
+# In-process response caches. Performance stats are invalidated whenever a trade is logged;
+# the regime score is a pure function of its inputs so it can live much longer.
+_performance_cache = TTLCache(maxsize=1, ttl=10)
+_performance_cache_lock = Lock()
+# Bumped on every invalidation, so a read that started before a write cannot store its older stats
+_performance_generation = 0
+
+def _invalidate_performance_cache():
+    """Drops the cached stats after trades were committed."""
+    global _performance_generation
+    with _performance_cache_lock:
+        _performance_generation += 1
+        _performance_cache.clear()
+
 @router.post("/log/trade", summary="Logs a trade into the database")
 def log_trade(trade: TradeInput, db: Session = Depends(get_db)):
     """
@@ -14,159 +55,195 @@ def log_trade(trade: TradeInput, db: Session = Depends(get_db)):
     like strategy, entry/exit prices, P&L, and market regime score.
     """
     try:
-        new_trade = Trade(**trade.model_dump())
-        db.add(new_trade)
+        # Single Core INSERT ... RETURNING round trip; no ORM instance, unit-of-work bookkeeping or refresh SELECT
+        trade_id = db.execute(_trades.insert().values(**trade.model_dump(exclude_unset=True)).returning(_trades.c.id)).scalar_one()
         db.commit()
-        db.refresh(new_trade)
-        return {"status": "success", "trade_id": new_trade.id}
+        _invalidate_performance_cache()
+        return {"status": "success", "trade_id": trade_id}
     except Exception as e:
         logger.error(f"Trade logging error: {e}")
         raise HTTPException(status_code=500, detail=f"Trade logging error: {str(e)}")
 
+@router.post("/log/trades", summary="Logs a batch of trades into the database")
+def log_trades(trades: list[TradeInput], db: Session = Depends(get_db)):
+    """
+    Logs several completed trades in one bulk INSERT and returns their IDs
+    in the same order as the request body.
+    """
+    try:
+        if not trades:
+            return {"status": "success", "trade_ids": []}
+        trade_ids = db.scalars(_trades.insert().returning(_trades.c.id, sort_by_parameter_order=True), [t.model_dump(exclude_unset=True) for t in trades]).all()
+        db.commit()
+        _invalidate_performance_cache()
+        return {"status": "success", "trade_ids": trade_ids}
+    except Exception as e:
+        logger.error(f"Batch trade logging error: {e}")
+        raise HTTPException(status_code=500, detail=f"Batch trade logging error: {str(e)}")
+
 @router.get("/analytics/performance", summary="Retrieves overall trading performance analytics")
-def get_performance_analytics(db: Session = Depends(get_db)):
+def get_performance_analytics(db: Connection = Depends(get_db_readonly)):
     """
     Provides aggregated performance statistics from all logged trades,
     including total trades, total P&L, average regime score, and win/loss counts.
     """
     try:
-        trades = db.query(Trade).all()
-        total = len(trades)
-        if total == 0:
-            return {
-                "total_trades": 0,
-                "total_pnl": 0.0,
-                "avg_regime_score": 0.0,
-                "winning_trades": 0,
-                "losing_trades": 0
-            }
-        total_pnl = sum(t.pnl for t in trades)
-        avg_regime = sum(t.regime_score for t in trades) / total
-        winning_trades = sum(1 for t in trades if t.pnl > 0)
-        losing_trades = sum(1 for t in trades if t.pnl < 0)
-        return {
+        with _performance_cache_lock:
+            cached_result = _performance_cache.get("performance")
+            generation = _performance_generation
+        if cached_result is not None:
+            return cached_result
+
+        # Aggregate in a single SQL pass instead of hydrating every Trade row
+        stmt = select(
+            func.count(Trade.id),
+            func.coalesce(func.sum(Trade.pnl), 0.0),
+            func.coalesce(func.avg(Trade.regime_score), 0.0),
+            func.coalesce(func.sum(case((Trade.pnl > 0, 1), else_=0)), 0),
+            func.coalesce(func.sum(case((Trade.pnl < 0, 1), else_=0)), 0),
+        )
+        total, total_pnl, avg_regime, winning_trades, losing_trades = db.execute(stmt).one()
+        result = {
             "total_trades": total,
-            "total_pnl": round(total_pnl, 2),
-            "avg_regime_score": round(avg_regime, 2),
+            "total_pnl": round(float(total_pnl), 2),
+            "avg_regime_score": round(float(avg_regime), 2),
             "winning_trades": winning_trades,
             "losing_trades": losing_trades
         }
+        with _performance_cache_lock:
+            if generation == _performance_generation:
+                _performance_cache["performance"] = result
+        return result
     except Exception as e:
         logger.error(f"Performance analytics error: {e}")
         raise HTTPException(status_code=500, detail=f"Performance analytics error: {str(e)}")
 
-@router.post("/risk/check", summary="Performs real-time risk checks based on defined parameters")
-def check_risk(data: RiskCheckInput):
+def _evaluate_risk(checks: list[RiskCheckInput]):
+    """Runs the vectorized risk check over a list of inputs and formats alerts per input."""
+    fields = ("estimated_loss", "max_loss_allowed", "daily_pnl", "max_daily_limit", "iv_rv_ratio")
+    arrays = {f: np.array([getattr(c, f) for c in checks], dtype=np.float64) for f in fields}
+    adjusted_loss, potential_daily_pnl, max_loss_breached, daily_limit_breached = check_risk_batch(**arrays)
+
+    results = []
+    for i, c in enumerate(checks):
+        alerts = []
+        if max_loss_breached[i]:
+            alerts.append(f"Max loss exceeded: Projected loss {adjusted_loss[i]:.2f} > Allowed {c.max_loss_allowed:.2f}")
+        if daily_limit_breached[i]:
+            alerts.append(f"Daily loss limit breached: Current + Projected P&L {potential_daily_pnl[i]:.2f} < Daily limit -{c.max_daily_limit:.2f}")
+        results.append({"status": "BLOCK" if alerts else "ALLOW", "alerts": alerts})
+    return results
+
+@router.post("/risk/check", summary="Performs real-time risk checks based on defined parameters", openapi_extra=_json_body(_RiskCheckAdapter))
+async def check_risk(request: Request):
     """
     Evaluates a potential trade against predefined risk parameters such as
     max loss allowed, estimated loss, daily P&L, and daily loss limits.
     Returns "ALLOW" or "BLOCK" with alerts.
     """
+    data = await _validate_body(request, _RiskCheckAdapter)
     try:
-        alerts = []
-        vol_factor = 1.0 + (data.iv_rv_ratio - 1) * 0.5 if data.iv_rv_ratio > 1 else 1.0
-        adjusted_loss = data.estimated_loss * vol_factor
-        if adjusted_loss > data.max_loss_allowed:
-            alerts.append(f"Max loss exceeded: Projected loss {adjusted_loss:.2f} > Allowed {data.max_loss_allowed:.2f}")
-
-        potential_daily_pnl = data.daily_pnl - adjusted_loss
-        if potential_daily_pnl < -abs(data.max_daily_limit):
-            alerts.append(f"Daily loss limit breached: Current + Projected P&L {potential_daily_pnl:.2f} < Daily limit -{data.max_daily_limit:.2f}")
-
-        return {"status": "BLOCK" if alerts else "ALLOW", "alerts": alerts}
+        return _evaluate_risk([data])[0]
     except Exception as e:
         logger.error(f"Risk check error: {e}")
         raise HTTPException(status_code=500, detail=f"Risk check error: {str(e)}")
 
-@router.post("/regime/score", summary="Calculates a market regime score based on various indicators")
-def get_regime_score(data: RegimeInput):
+@router.post("/risk/check/batch", summary="Performs risk checks for a batch of candidate trades", openapi_extra=_json_body(_RiskCheckBatchAdapter))
+async def check_risk_batch_endpoint(request: Request):
+    """
+    Evaluates many candidate trades in one vectorized pass.
+    Returns an "ALLOW"/"BLOCK" result with alerts for each input, in order.
+    """
+    data = await _validate_body(request, _RiskCheckBatchAdapter)
+    try:
+        return {"results": _evaluate_risk(data) if data else []}
+    except Exception as e:
+        logger.error(f"Batch risk check error: {e}")
+        raise HTTPException(status_code=500, detail=f"Batch risk check error: {str(e)}")
+
+# Regime scoring rules, evaluated once per indicator: the first matching (condition, points, explanation)
+# wins. Conditions only use comparison/bitwise operators so they also work elementwise on Series.
+_REGIME_RULES = (
+    ("ivp", (
+        (lambda v: v > 70, 3, "Very high IVP (>70%) indicates high option premiums."),
+        (lambda v: v > 50, 2, "High IVP (>50%) indicates elevated option premiums."),
+    )),
+    ("vix", (
+        (lambda v: v > 20, 3, "High VIX (>20) suggests significant market fear."),
+        (lambda v: v > 14, 2, "Elevated VIX (>14) indicates increased volatility expectations."),
+    )),
+    ("pcr", (
+        (lambda v: v > 1.5, 2, "Very bullish PCR ({value})."),
+        (lambda v: v < 0.7, 2, "Very bearish PCR ({value})."),
+        (lambda v: (v >= 0.9) & (v <= 1.1), 1, "Neutral PCR ({value})."),
+    )),
+    ("fii_net", (
+        (lambda v: v > 2000, 2, "Strong FII net long positioning (>2000 Cr)."),
+        (lambda v: v < -1000, 2, "Strong FII net short positioning (<-1000 Cr)."),
+    )),
+    ("event_impact", (
+        (lambda v: v > 0.7, 3, "High event impact score (>0.7) indicates significant potential market moves."),
+        (lambda v: v > 0.4, 1, "Moderate event impact score (>0.4)."),
+    )),
+    ("realized_vol", (
+        (lambda v: v > 20, 3, "Very high realized volatility (>20%) indicates sharp price swings."),
+        (lambda v: v > 15, 1, "High realized volatility (>15%)."),
+    )),
+    ("iv_skew_slope", (
+        (lambda v: v > 0.7, 2, "Steep IV skew slope (>0.7) suggests bearish sentiment (puts are expensive)."),
+        (lambda v: v < -0.3, 1, "Negative IV skew slope (<-0.3) suggests bullish sentiment (calls are expensive)."),
+    )),
+)
+
+@cached(TTLCache(maxsize=1024, ttl=3600), lock=Lock())
+def _compute_regime_score(data: RegimeInput):
+    """Scores a (hashable, frozen) set of regime indicators."""
+    score = 0
+    explanation = []
+    for field, rules in _REGIME_RULES:
+        value = getattr(data, field)
+        for condition, points, message in rules:
+            if condition(value):
+                score += points
+                explanation.append(message.format(value=value))
+                break
+
+    regime = "Uncertain/Volatile"
+    if score >= 10:
+        regime = "High Volatility / Event Driven"
+    elif score >= 6:
+        regime = "Trend-Following / Moderate Volatility"
+    elif score < 3:
+        regime = "Low Volatility / Range-Bound"
+
+    return {
+        "regime_score": score,
+        "regime": regime,
+        "explanation": explanation
+    }
+
+@router.post("/regime/score", summary="Calculates a market regime score based on various indicators", openapi_extra=_json_body(_RegimeAdapter))
+async def get_regime_score(request: Request):
     """
     Calculates a composite market regime score based on indicators like IVP, PCR, VIX,
     FII/DII net positioning, event impact, realized volatility, and IV skew slope.
     Classifies the market into categories (e.g., High Volatility, Range-Bound).
     """
+    data = await _validate_body(request, _RegimeAdapter)
     try:
-        score = 0
-        explanation = []
-
-        if data.ivp > 70:
-            score += 3
-            explanation.append("Very high IVP (>70%) indicates high option premiums.")
-        elif data.ivp > 50:
-            score += 2
-            explanation.append("High IVP (>50%) indicates elevated option premiums.")
-
-        if data.vix > 20:
-            score += 3
-            explanation.append("High VIX (>20) suggests significant market fear.")
-        elif data.vix > 14:
-            score += 2
-            explanation.append("Elevated VIX (>14) indicates increased volatility expectations.")
-
-        if data.pcr > 1.5:
-            score += 2
-            explanation.append(f"Very bullish PCR ({data.pcr}).")
-        elif data.pcr < 0.7:
-            score += 2
-            explanation.append(f"Very bearish PCR ({data.pcr}).")
-        elif 0.9 <= data.pcr <= 1.1:
-            score += 1
-            explanation.append(f"Neutral PCR ({data.pcr}).")
-
-        if data.fii_net > 2000:
-            score += 2
-            explanation.append("Strong FII net long positioning (>2000 Cr).")
-        elif data.fii_net < -1000:
-            score += 2
-            explanation.append("Strong FII net short positioning (<-1000 Cr).")
-
-        if data.event_impact > 0.7:
-            score += 3
-            explanation.append("High event impact score (>0.7) indicates significant potential market moves.")
-        elif data.event_impact > 0.4:
-            score += 1
-            explanation.append("Moderate event impact score (>0.4).")
-
-        if data.realized_vol > 20:
-            score += 3
-            explanation.append("Very high realized volatility (>20%) indicates sharp price swings.")
-        elif data.realized_vol > 15:
-            score += 1
-            explanation.append("High realized volatility (>15%).")
-
-        if data.iv_skew_slope > 0.7:
-            score += 2
-            explanation.append("Steep IV skew slope (>0.7) suggests bearish sentiment (puts are expensive).")
-        elif data.iv_skew_slope < -0.3:
-            score += 1
-            explanation.append("Negative IV skew slope (<-0.3) suggests bullish sentiment (calls are expensive).")
-
-        regime = "Uncertain/Volatile"
-        if score >= 10:
-            regime = "High Volatility / Event Driven"
-        elif score >= 6:
-            regime = "Trend-Following / Moderate Volatility"
-        elif score < 3:
-            regime = "Low Volatility / Range-Bound"
-
-        return {
-            "regime_score": score,
-            "regime": regime,
-            "explanation": explanation
-        }
+        return _compute_regime_score(data)
     except Exception as e:
         logger.error(f"Regime score error: {e}")
         raise HTTPException(status_code=500, detail=f"Regime score error: {str(e)}")
 
 @router.get("/discipline/score", summary="Retrieves the trading discipline score")
-def get_discipline_score_endpoint(db: Session = Depends(get_db)):
+def get_discipline_score_endpoint(db: Connection = Depends(get_db_readonly)):
     """
     Calculates and returns a trading discipline score based on historical trades,
     identifying potential violations like excessive high-risk trades or overtrading.
     """
     try:
-        trades = db.query(Trade).all()
-        result = calculate_discipline_score(trades)
+        result = calculate_discipline_score(db)
         return result
     except Exception as e:
         logger.error(f"Discipline score endpoint error: {e}")
@@ -1,90 +1,170 @@
 from fastapi import APIRouter, HTTPException, Depends
-from datetime import datetime
+from fastapi.responses import ORJSONResponse
+from functools import lru_cache
+import asyncio
+import time
+from contextlib import asynccontextmanager
+import httpx
 import pandas as pd
-import upstox_client
+from cachetools import TTLCache
 from app.config import settings, logger
 from app.models import OptionChainInput, MarketDepthInput
-from app.utils.upstox_helpers import fetch_expiry, fetch_option_chain_raw, get_market_depth, get_upstox_config
-from app.utils.data_processing import process_chain_data, calculate_metrics_data
+from app.dependencies import get_http_client
+from app.utils.upstox_helpers import fetch_expiry_dates, nearest_expiry, fetch_option_chain_raw, get_market_depth
+from app.utils.data_processing import process_chain_data, calculate_metrics_data, find_atm_index
 from app.utils.volatility_calcs import compute_realized_vol
 
 router = APIRouter()
 
-@router.post("/option-chain", summary="Fetches and processes live option chain data")
-async def get_option_chain_endpoint(data: OptionChainInput):
+# Processed option-chain responses keyed by (access_token, instrument_key, expiry). A snapshot is served as-is
+# while fresh, and served stale (with a background refresh) until the cache entry itself expires. Keying on the
+# token means a snapshot is only ever served to the token Upstox accepted when building it, and its refreshes
+# reuse that same token.
+_CHAIN_FRESH_SECONDS = 2
+_chain_snapshots = TTLCache(maxsize=256, ttl=10)
+_chain_refreshes = {} # snapshot key -> in-flight refresh task
+_chain_build_locks = {} # snapshot key -> single-flight lock for cold builds, see _single_flight
+# Contract expiry lists only change when a series is listed or expires, so they are kept for an hour;
+# the nearest expiry is still picked per request so it rolls over at midnight without invalidation
+_expiry_cache = TTLCache(maxsize=256, ttl=3600) # (access_token, instrument_key) -> sorted expiries
+_expiry_locks = {}
+
+@asynccontextmanager
+async def _single_flight(locks: dict, key):
+    """Holds the lock for key, creating it on first use and dropping it once no request holds or waits on it."""
+    entry = locks.get(key)
+    if entry is None:
+        entry = locks[key] = [asyncio.Lock(), 0] # lock, number of requests using it
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del locks[key]
+
+@lru_cache(maxsize=1)
+def _format_timestamp(epoch_second: int) -> str:
+    """Local "%Y-%m-%d %H:%M:%S" timestamp, formatted once per second."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(epoch_second))
+
+async def _safe_depth(http: httpx.AsyncClient, access_token: str, token: str, side: str):
+    """Fetches depth for one ATM leg, falling back to zero volumes if it is missing or the call fails."""
+    if not token:
+        return {"bid_volume": 0, "ask_volume": 0}
+    try:
+        return await get_market_depth(http, access_token, token)
+    except Exception as e:
+        logger.warning(f"Could not fetch {side} depth for {token}: {e}")
+        return {"bid_volume": 0, "ask_volume": 0}
+
+async def _build_option_chain(data: OptionChainInput, http: httpx.AsyncClient, expiry: str):
+    """Fetches the raw chain for an expiry and computes the /option-chain response."""
+    chain = await fetch_option_chain_raw(http, data.access_token, data.instrument_key, expiry)
+    if not chain:
+        logger.error("Failed to retrieve option chain data.")
+        raise HTTPException(status_code=500, detail="Failed to retrieve option chain data.")
+
+    # Extract spot price from the raw chain data
+    spot = chain[0].get("underlying_spot_price")
+    if not spot:
+        logger.error("Failed to retrieve spot price from option chain.")
+        raise HTTPException(status_code=500, detail="Failed to retrieve spot price.")
+
+    df_processed, ce_oi, pe_oi = process_chain_data(chain)
+    if df_processed.empty:
+        logger.error("Processed option chain DataFrame is empty.")
+        raise HTTPException(status_code=500, detail="Processed option chain DataFrame is empty.")
+
+    pcr, max_pain, straddle_price, atm_strike, atm_iv = calculate_metrics_data(df_processed, ce_oi, pe_oi, spot)
+
+    # Get instrument tokens for ATM CE and PE for depth fetching
+    atm_pos = find_atm_index(df_processed['Strike'].to_numpy(), spot)
+    ce_token = df_processed['CE_Token'].iat[atm_pos] or None
+    pe_token = df_processed['PE_Token'].iat[atm_pos] or None
+
+    # Both depth calls and the realized-vol history load are independent I/O waits; overlap them
+    ce_depth, pe_depth, realized_vol = await asyncio.gather(
+        _safe_depth(http, data.access_token, ce_token, "CE"),
+        _safe_depth(http, data.access_token, pe_token, "PE"),
+        asyncio.to_thread(compute_realized_vol),
+    )
+
+    return {
+        "nifty_spot": spot,
+        "atm_strike": atm_strike,
+        "straddle_price": straddle_price,
+        "pcr": round(pcr, 2),
+        "max_pain": max_pain,
+        "expiry": expiry,
+        # Full DF might be large but required for strategy; 4 decimals is well past quote/greek precision and keeps
+        # float noise (e.g. 0.30000000000000004) out of the payload
+        "iv_skew_data": df_processed.round(4).to_dict(orient='records'),
+        "ce_depth": ce_depth,
+        "pe_depth": pe_depth,
+        "atm_iv": round(atm_iv, 2),
+        "realized_volatility": realized_vol,
+        "timestamp": _format_timestamp(int(time.time())),
+        "data": chain # Raw chain data, only returned with include_raw
+    }
+
+def _select_payload(response_data: dict, include_raw: bool):
+    """Drops the raw chain, which duplicates iv_skew_data, unless the caller asked for it."""
+    if include_raw:
+        return response_data
+    return {k: v for k, v in response_data.items() if k != "data"}
+
+async def _refresh_option_chain(data: OptionChainInput, http: httpx.AsyncClient, expiry: str):
+    """Rebuilds a stale option-chain snapshot in the background, with the token that built it."""
+    key = (data.access_token, data.instrument_key, expiry)
+    try:
+        _chain_snapshots[key] = (time.monotonic(), await _build_option_chain(data, http, expiry))
+    except Exception as e:
+        logger.warning(f"Background option chain refresh failed for {data.instrument_key}: {e}")
+    finally:
+        _chain_refreshes.pop(key, None)
+
+@router.post("/option-chain", summary="Fetches and processes live option chain data", response_class=ORJSONResponse)
+async def get_option_chain_endpoint(data: OptionChainInput, http: httpx.AsyncClient = Depends(get_http_client)):
     """
     Fetches and processes live option chain data for a given instrument.
     Calculates key metrics like PCR, Max Pain, ATM IV, and Realized Volatility.
+    Responses are cached for a few seconds and refreshed in the background once stale.
     """
-    # Initialize Upstox API client for this specific request
-    config = get_upstox_config(data.access_token)
-    api_client = upstox_client.ApiClient(config)
-    options_api = upstox_client.OptionsApi(api_client)
-
     try:
-        expiry = fetch_expiry(options_api, data.instrument_key)
+        expiry_key = (data.access_token, data.instrument_key)
+        expiry_dates = _expiry_cache.get(expiry_key)
+        if expiry_dates is None:
+            async with _single_flight(_expiry_locks, expiry_key):
+                expiry_dates = _expiry_cache.get(expiry_key)
+                if expiry_dates is None:
+                    expiry_dates = await fetch_expiry_dates(http, data.access_token, data.instrument_key)
+                    if expiry_dates:
+                        _expiry_cache[expiry_key] = expiry_dates
+        expiry = nearest_expiry(expiry_dates)
         if not expiry:
             logger.error("Failed to retrieve nearest expiry date.")
             raise HTTPException(status_code=500, detail="Failed to retrieve nearest expiry date.")
 
-        chain = fetch_option_chain_raw(options_api, data.instrument_key, expiry)
-        if not chain:
-            logger.error("Failed to retrieve option chain data.")
-            raise HTTPException(status_code=500, detail="Failed to retrieve option chain data.")
-
-        # Extract spot price from the raw chain data
-        spot = chain[0].get("underlying_spot_price")
-        if not spot:
-            logger.error("Failed to retrieve spot price from option chain.")
-            raise HTTPException(status_code=500, detail="Failed to retrieve spot price.")
-
-        df_processed, ce_oi, pe_oi = process_chain_data(chain)
-        if df_processed.empty:
-            logger.error("Processed option chain DataFrame is empty.")
-            raise HTTPException(status_code=500, detail="Processed option chain DataFrame is empty.")
-
-        pcr, max_pain, straddle_price, atm_strike, atm_iv = calculate_metrics_data(df_processed, ce_oi, pe_oi, spot)
-
-        # Get instrument tokens for ATM CE and PE for depth fetching
-        ce_token_row = df_processed[(df_processed['Strike'] == atm_strike) & (df_processed['CE_Token'] != '')]
-        pe_token_row = df_processed[(df_processed['Strike'] == atm_strike) & (df_processed['PE_Token'] != '')]
-
-        ce_token = ce_token_row['CE_Token'].values[0] if not ce_token_row.empty else None
-        pe_token = pe_token_row['PE_Token'].values[0] if not pe_token_row.empty else None
-
-        ce_depth = {"bid_volume": 0, "ask_volume": 0}
-        if ce_token:
-            try:
-                ce_depth = get_market_depth(data.access_token, ce_token)
-            except Exception as e:
-                logger.warning(f"Could not fetch CE depth for {ce_token}: {e}")
-
-        pe_depth = {"bid_volume": 0, "ask_volume": 0}
-        if pe_token:
-            try:
-                pe_depth = get_market_depth(data.access_token, pe_token)
-            except Exception as e:
-                logger.warning(f"Could not fetch PE depth for {pe_token}: {e}")
-
-        realized_vol = compute_realized_vol()
-
-        response_data = {
-            "nifty_spot": spot,
-            "atm_strike": atm_strike,
-            "straddle_price": straddle_price,
-            "pcr": round(pcr, 2),
-            "max_pain": max_pain,
-            "expiry": expiry,
-            "iv_skew_data": df_processed.to_dict(orient='records'), # Full DF might be large but required for strategy
-            "ce_depth": ce_depth,
-            "pe_depth": pe_depth,
-            "atm_iv": round(atm_iv, 2),
-            "realized_volatility": realized_vol,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "data": chain # Raw chain data for strategy execution
-        }
+        key = (data.access_token, data.instrument_key, expiry)
+        snapshot = _chain_snapshots.get(key)
+        if snapshot is not None:
+            built_at, response_data = snapshot
+            if time.monotonic() - built_at > _CHAIN_FRESH_SECONDS and key not in _chain_refreshes:
+                _chain_refreshes[key] = asyncio.create_task(_refresh_option_chain(data, http, expiry))
+            return ORJSONResponse(_select_payload(response_data, data.include_raw))
+
+        # On a cold miss only the first request builds; concurrent ones wait and reuse its snapshot
+        async with _single_flight(_chain_build_locks, key):
+            snapshot = _chain_snapshots.get(key)
+            if snapshot is not None:
+                return ORJSONResponse(_select_payload(snapshot[1], data.include_raw))
+            response_data = await _build_option_chain(data, http, expiry)
+            _chain_snapshots[key] = (time.monotonic(), response_data)
         logger.info("Successfully fetched and processed market data via /option-chain.")
-        return response_data
+        # Serialize straight to orjson; walking the large payload with jsonable_encoder first is the slow part
+        return ORJSONResponse(_select_payload(response_data, data.include_raw))
 
     except HTTPException as e:
         raise e
@@ -1,15 +1,67 @@
-from fastapi import APIRouter, HTTPException
-import time
+from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import ORJSONResponse
+import asyncio
+import httpx
 import numpy as np
-import pandas as pd
 from datetime import timedelta
 from app.config import logger, settings
 from app.models import StrategyInput, StrategyExecuteInput, BacktestInput
+from app.dependencies import get_http_client
 from app.utils.data_processing import build_strategy_legs
+from app.utils.kernels import compute_intrinsic
+from app.utils.volatility_calcs import load_nifty_history
 from app.utils.upstox_helpers import place_order_for_leg, fetch_trade_pnl
 
 router = APIRouter()
 
+# Regime classification for strategy suggestions: the first matching condition names the regime.
+# Conditions only use comparison/bitwise operators so they evaluate elementwise over arrays of inputs.
+_SUGGEST_REGIMES = (
+    (lambda d: (d["ivp"] > 60) & (d["vix"] > 18), "High Volatility Expansion"), # Typically favors short straddles/strangles if mean-reversion expected
+    (lambda d: (d["ivp"] < 30) & (d["vix"] < 12), "Low Volatility Contraction"), # Typically favors long straddles/strangles for breakout
+    (lambda d: (d["pcr"] > 1.2) | (d["pcr"] < 0.8), "Extreme Sentiment"), # Could imply reversal or continuation
+    (lambda d: d["iv_skew_slope"] > 0.5, "Bearish Skew"), # Puts expensive, implies downside concern
+)
+
+# Suggestion rule groups: each group contributes its first matching strategy, in group order.
+_SUGGEST_STRATEGIES = (
+    (
+        (lambda d: d["regime"] == "High Volatility Expansion", {"name": "Short Straddle / Strangle (for IV mean reversion)", "confidence": 0.8, "max_loss_estimate": 5000}),
+        (lambda d: d["regime"] == "Low Volatility Contraction", {"name": "Long Straddle / Strangle (for breakout)", "confidence": 0.7, "max_loss_estimate": 4000}),
+    ),
+    (
+        (lambda d: d["pcr"] > 1.2, {"name": "Bull Put Spread", "confidence": 0.6, "max_loss_estimate": 3000}), # Bullish sentiment from PCR
+        (lambda d: d["pcr"] < 0.8, {"name": "Bear Call Spread", "confidence": 0.6, "max_loss_estimate": 3000}), # Bearish sentiment from PCR
+    ),
+    (
+        (lambda d: (d["ivp"] >= 50) & (d["vix"] > 13.5) & (d["straddle_price"] >= 150), {"name": "Iron Fly (for range-bound with high IV)", "confidence": 0.75, "max_loss_estimate": 5000}),
+        (lambda d: (d["vix"] < 12) & (d["pcr"] >= 0.9) & (d["pcr"] <= 1.1), {"name": "Short Strangle (for low volatility, sideways)", "confidence": 0.7, "max_loss_estimate": 3500}),
+    ),
+)
+
+_NO_STRATEGY = {"name": "No clear strategy suggested by current metrics. Exercise caution.", "confidence": 0, "max_loss_estimate": 0}
+
+def _first_match(rules, d):
+    """Per input, the index of the first matching rule (or -1), evaluating every rule once over all inputs."""
+    matches = np.column_stack([condition(d) for condition, _ in rules])
+    return np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+
+def _suggest_strategies(inputs: list[StrategyInput]):
+    """Classifies the regime and suggests strategies for many metric sets in one vectorized pass."""
+    d = {field: np.array([getattr(x, field) for x in inputs], dtype=np.float64) for field in StrategyInput.model_fields}
+    regime_names = np.array([name for _, name in _SUGGEST_REGIMES] + ["Neutral"])
+    d["regime"] = regime_names[_first_match(_SUGGEST_REGIMES, d)] # -1 picks the trailing "Neutral"
+    group_picks = [(group, _first_match(group, d)) for group in _SUGGEST_STRATEGIES]
+
+    results = []
+    for i in range(len(inputs)):
+        strategies = [dict(group[picks[i]][1]) for group, picks in group_picks if picks[i] >= 0]
+        results.append({
+            "regime": str(d["regime"][i]),
+            "suggested_strategies": strategies or [dict(_NO_STRATEGY)]
+        })
+    return results
+
 @router.post("/strategy/suggest", summary="Suggests option strategies based on market metrics")
 def suggest_strategy(data: StrategyInput):
     """
@@ -17,50 +69,36 @@ def suggest_strategy(data: StrategyInput):
     such as IVP, VIX, PCR, straddle price, event impact, ATM IV, realized volatility, and IV skew.
     """
     try:
-        iv_rv = data.atm_iv / data.realized_vol if data.realized_vol else 0
-
-        # Refined regime classification
-        regime = "Neutral"
-        if data.ivp > 60 and data.vix > 18:
-            regime = "High Volatility Expansion" # Typically favors short straddles/strangles if mean-reversion expected
-        elif data.ivp < 30 and data.vix < 12:
-            regime = "Low Volatility Contraction" # Typically favors long straddles/strangles for breakout
-        elif data.pcr > 1.2 or data.pcr < 0.8:
-            regime = "Extreme Sentiment" # Could imply reversal or continuation
-        elif data.iv_skew_slope > 0.5:
-            regime = "Bearish Skew" # Puts expensive, implies downside concern
-
-        strategies = []
-
-        # Adapt suggestions based on refined regimes or direct conditions
-        if regime == "High Volatility Expansion":
-            strategies.append({"name": "Short Straddle / Strangle (for IV mean reversion)", "confidence": 0.8, "max_loss_estimate": 5000})
-        elif regime == "Low Volatility Contraction":
-            strategies.append({"name": "Long Straddle / Strangle (for breakout)", "confidence": 0.7, "max_loss_estimate": 4000})
-
-        if data.pcr > 1.2: # Bullish sentiment from PCR
-            strategies.append({"name": "Bull Put Spread", "confidence": 0.6, "max_loss_estimate": 3000})
-        elif data.pcr < 0.8: # Bearish sentiment from PCR
-            strategies.append({"name": "Bear Call Spread", "confidence": 0.6, "max_loss_estimate": 3000})
-
-        if data.ivp >= 50 and data.vix > 13.5 and data.straddle_price >= 150:
-             strategies.append({"name": "Iron Fly (for range-bound with high IV)", "confidence": 0.75, "max_loss_estimate": 5000})
-        elif data.vix < 12 and 0.9 <= data.pcr <= 1.1:
-            strategies.append({"name": "Short Strangle (for low volatility, sideways)", "confidence": 0.7, "max_loss_estimate": 3500})
-
-        if not strategies:
-            strategies.append({"name": "No clear strategy suggested by current metrics. Exercise caution.", "confidence": 0, "max_loss_estimate": 0})
-
-        return {
-            "regime": regime,
-            "suggested_strategies": strategies
-        }
+        return _suggest_strategies([data])[0]
     except Exception as e:
         logger.error(f"Strategy suggestion error: {e}")
         raise HTTPException(status_code=500, detail=f"Strategy suggestion error: {str(e)}")
 
+@router.post("/strategy/suggest/batch", summary="Suggests option strategies for a batch of market metric sets")
+def suggest_strategy_batch(data: list[StrategyInput]):
+    """
+    Scores many metric sets (e.g. one per day) in one vectorized pass.
+    Returns a regime and suggested strategies for each input, in order.
+    """
+    try:
+        return {"results": _suggest_strategies(data) if data else []}
+    except Exception as e:
+        logger.error(f"Batch strategy suggestion error: {e}")
+        raise HTTPException(status_code=500, detail=f"Batch strategy suggestion error: {str(e)}")
+
+def _chain_from_records(records: list):
+    """Rebuilds the raw chain shape build_strategy_legs expects from /option-chain iv_skew_data records."""
+    return [
+        {
+            "strike_price": r["Strike"],
+            "call_options": {"instrument_key": r.get("CE_Token"), "market_data": {"ltp": r.get("CE_LTP", 0.0)}},
+            "put_options": {"instrument_key": r.get("PE_Token"), "market_data": {"ltp": r.get("PE_LTP", 0.0)}},
+        }
+        for r in records if "Strike" in r
+    ]
+
 @router.post("/strategy/execute", summary="Executes a defined option strategy")
-async def execute_strategy(data: StrategyExecuteInput):
+async def execute_strategy(data: StrategyExecuteInput, http: httpx.AsyncClient = Depends(get_http_client)):
     """
     Executes a predefined option strategy (Iron Fly, Iron Condor, Bull Put Spread, Bear Call Spread)
     via the Upstox API. This involves placing multiple individual orders.
@@ -68,8 +106,8 @@ async def execute_strategy(data: StrategyExecuteInput):
     try:
         quantity = int(float(data.quantity))
 
-        # The option_chain field should contain the raw 'data' from /option-chain endpoint
-        raw_option_chain_data = data.option_chain.get('data', [])
+        # Prefer the raw 'data' from /option-chain (include_raw); otherwise rebuild it from the processed rows
+        raw_option_chain_data = data.option_chain.get('data') or _chain_from_records(data.option_chain.get('iv_skew_data', []))
         legs = build_strategy_legs(raw_option_chain_data, data.spot_price, data.strategy_name, quantity, data.otm_distance)
         if not legs:
             raise HTTPException(status_code=400, detail=f"No valid legs could be built for {data.strategy_name}. Check OTM distance and option chain data.")
@@ -102,22 +140,25 @@ async def execute_strategy(data: StrategyExecuteInput):
         order_results = []
         total_pnl_realized = 0
 
-        # Execute orders sequentially to avoid rate limits and for simpler tracking.
-        for leg in legs:
-            result = await place_order_for_leg(data.access_token, leg)
-            if result and result.get('order_id'):
+        # Pass 1: place every leg concurrently
+        results = await asyncio.gather(*[place_order_for_leg(data.access_token, leg) for leg in legs], return_exceptions=True)
+        for leg, result in zip(legs, results):
+            if isinstance(result, Exception):
+                logger.error(f"Order placement failed for leg: {leg}. Error: {result}")
+            elif result and result.get('order_id'):
                 order_results.append(result)
-                order_id = result['order_id']
-                # In a real-time system, you'd track order status and execute exit strategies.
-                # For this demo, we'll simulate P&L by fetching trade P&L after a delay.
-                time.sleep(2) # Wait for order to potentially execute and trade to settle
-                pnl = fetch_trade_pnl(data.access_token, order_id) # This PnL might be 0 for open trades
-                total_pnl_realized += pnl # This accumulation is only meaningful if trades are closed
-
             else:
                 logger.error(f"Order placement failed for leg: {leg}. Result: {result}")
                 # Consider what to do if a leg fails: stop execution, notify, or attempt retry?
 
+        # Pass 2: one settle delay for the whole batch, then one request for every order's P&L.
+        # In a real-time system, you'd track order status and execute exit strategies.
+        # For this demo, we'll simulate P&L by fetching trade P&L after a delay.
+        if order_results:
+            await asyncio.sleep(2) # Wait for orders to potentially execute and trades to settle
+            # Only meaningful if trades are closed; open trades report 0
+            total_pnl_realized = await fetch_trade_pnl(http, data.access_token, [r['order_id'] for r in order_results])
+
         return {
             "order_results": order_results,
             "trade_pnl_simulation": total_pnl_realized, # Emphasize this is simulated/partial
@@ -130,7 +171,17 @@ async def execute_strategy(data: StrategyExecuteInput):
         raise HTTPException(status_code=500, detail=f"Strategy execution error: {str(e)}")
 
 
-@router.post("/backtest", summary="Backtests a given option strategy over a historical period (Simulated)")
+# Backtest leg layout per strategy: (anchor, offset in otm_distance steps, option type, action).
+# "atm" legs sit at the ATM strike plus the offset; "spot" legs take the strike nearest to spot
+# plus the offset, mirroring how build_strategy_legs places each strategy.
+_BACKTEST_LEGS = {
+    "iron_fly": (("atm", 0, "CE", "SELL"), ("atm", 0, "PE", "SELL"), ("atm", 1, "CE", "BUY"), ("atm", -1, "PE", "BUY")),
+    "iron_condor": (("atm", 1, "CE", "SELL"), ("atm", 2, "CE", "BUY"), ("atm", -1, "PE", "SELL"), ("atm", -2, "PE", "BUY")),
+    "bull_put_spread": (("spot", -1, "PE", "SELL"), ("spot", -2, "PE", "BUY")),
+    "bear_call_spread": (("spot", 1, "CE", "SELL"), ("spot", 2, "CE", "BUY")),
+}
+
+@router.post("/backtest", summary="Backtests a given option strategy over a historical period (Simulated)", response_class=ORJSONResponse)
 def backtest_strategy(data: BacktestInput):
     """
     Performs a simulated backtest of a given option strategy over historical Nifty data.
@@ -138,12 +189,7 @@ def backtest_strategy(data: BacktestInput):
     Option prices are approximated based on spot and random extrinsic value.
     """
     try:
-        df = pd.read_csv(settings.NIFTY_HISTORICAL_DATA_URL)
-        df.columns = df.columns.str.strip()
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce", format="%d-%b-%Y")
-        df = df.dropna(subset=["Date"]).set_index("Date").sort_index()
-        if 'Close' not in df.columns:
-            raise ValueError(f"CSV file does not contain 'Close' column")
+        df = load_nifty_history(settings.NIFTY_HISTORICAL_DATA_URL)
 
         end_date = df.index[-1]
         start_date = end_date - timedelta(days=data.period)
@@ -153,89 +199,54 @@ def backtest_strategy(data: BacktestInput):
             raise HTTPException(status_code=400, detail="Not enough data for the specified backtesting period.")
 
         quantity = int(float(data.quantity))
-        np.random.seed(42) # For reproducibility
-
-        trades_history = []
-        for i in range(len(df_backtest) - 1):
-            current_date = df_backtest.index[i]
-            spot = df_backtest['Close'].iloc[i]
-            next_spot = df_backtest['Close'].iloc[i + 1] # Next day's close for P&L calculation
-
-            # Simulate option chain for the current day
-            atm_strike = round(spot / 50) * 50
-            simulated_strikes = sorted(list(set([
-                atm_strike - 200, atm_strike - 150, atm_strike - 100, atm_strike - 50,
-                atm_strike,
-                atm_strike + 50, atm_strike + 100, atm_strike + 150, atm_strike + 200
-            ])))
-
-            mock_chain_data = []
-            for s in simulated_strikes:
-                ce_intrinsic = max(0, spot - s)
-                pe_intrinsic = max(0, s - spot)
-
-                # Simulate extrinsic value (more for ATM, less for OTM)
-                ce_extrinsic = np.random.uniform(5, 25) if abs(s - spot) < 100 else np.random.uniform(1, 10)
-                pe_extrinsic = np.random.uniform(5, 25) if abs(s - spot) < 100 else np.random.uniform(1, 10)
-
-                mock_chain_data.append({
-                    "strike_price": s,
-                    "call_options": {
-                        "instrument_key": f"NSE_FO|NIFTY|{current_date.strftime('%Y%m%d')}CE{s}",
-                        "market_data": {"ltp": ce_intrinsic + ce_extrinsic}
-                    },
-                    "put_options": {
-                        "instrument_key": f"NSE_FO|NIFTY|{current_date.strftime('%Y%m%d')}PE{s}",
-                        "market_data": {"ltp": pe_intrinsic + pe_extrinsic}
-                    }
-                })
-
-            legs_to_execute = build_strategy_legs(mock_chain_data, spot, data.strategy_name, quantity, otm_distance=50)
-
-            daily_pnl = 0
-            for leg in legs_to_execute:
-                strike = leg['strike']
-                opt_type = 'call_options' if 'CE' in leg['instrument_key'] else 'put_options'
-
-                entry_ltp_for_leg = 0.0
-                for mc_item in mock_chain_data:
-                    if mc_item.get('strike_price') == strike and opt_type in mc_item:
-                        entry_ltp_for_leg = mc_item[opt_type].get('market_data', {}).get('ltp', 0.0) or 0.0
-                        break
-
-                intrinsic_at_exit = max(0, next_spot - strike) if 'CE' in leg['instrument_key'] else max(0, strike - next_spot)
-                # Simulate a decrease in extrinsic value (time decay + random noise)
-                simulated_exit_ltp_for_leg = intrinsic_at_exit + (np.random.uniform(0.1, 0.5) * (entry_ltp_for_leg - intrinsic_at_exit))
-                simulated_exit_ltp_for_leg = max(0.01, simulated_exit_ltp_for_leg) # LTP cannot be negative
-
-                if leg['action'] == 'SELL':
-                    daily_pnl += (entry_ltp_for_leg - simulated_exit_ltp_for_leg) * leg['quantity']
-                else: # BUY
-                    daily_pnl += (simulated_exit_ltp_for_leg - entry_ltp_for_leg) * leg['quantity']
-
-            trades_history.append({"date": current_date.strftime("%Y-%m-%d"), "pnl": daily_pnl})
-
-        total_pnl = sum(t["pnl"] for t in trades_history)
-        win_rate = sum(1 for t in trades_history if t["pnl"] > 0) / len(trades_history) if trades_history else 0
-
-        max_drawdown = 0
-        running_pnl = 0
-        peak_pnl = 0
-        for trade in trades_history:
-            running_pnl += trade["pnl"]
-            if running_pnl > peak_pnl:
-                peak_pnl = running_pnl
-            drawdown = peak_pnl - running_pnl
-            if drawdown > max_drawdown:
-                max_drawdown = drawdown
-
-        return {
+        legs_def = _BACKTEST_LEGS.get(data.strategy_name.lower())
+        if legs_def is None:
+            raise ValueError(f"Unknown strategy: {data.strategy_name}")
+        otm_distance = 50
+
+        closes = df_backtest['Close'].to_numpy(dtype=np.float64)
+        spots, next_spots = closes[:-1], closes[1:] # Enter at each day's close, mark P&L at the next day's close
+        rows = np.arange(len(spots))[:, None]
+
+        # Simulate the option chain for every day at once: 9 strikes around ATM, each priced at
+        # intrinsic plus a random extrinsic value (more for ATM, less for OTM)
+        grid = (np.round(spots / 50) * 50)[:, None] + np.arange(-200, 201, 50, dtype=np.float64)
+        rng = np.random.default_rng(42) # For reproducibility
+        near_atm = np.abs(grid - spots[:, None]) < 100
+        ce_ltp = compute_intrinsic(np.ones(grid.shape[1], dtype=np.bool_), spots, grid) + np.where(near_atm, rng.uniform(5, 25, grid.shape), rng.uniform(1, 10, grid.shape))
+        pe_ltp = compute_intrinsic(np.zeros(grid.shape[1], dtype=np.bool_), spots, grid) + np.where(near_atm, rng.uniform(5, 25, grid.shape), rng.uniform(1, 10, grid.shape))
+
+        # Pick each leg's strike column per day the way build_strategy_legs would (nearest strike, lower on ties)
+        def nearest(target):
+            return np.abs(grid - target[:, None]).argmin(axis=1)
+        atm_strikes = grid[rows[:, 0], nearest(spots)]
+        leg_cols = np.column_stack([nearest((atm_strikes if anchor == "atm" else spots) + offset * otm_distance) for anchor, offset, _, _ in legs_def])
+        leg_is_call = np.array([opt_type == "CE" for _, _, opt_type, _ in legs_def])
+        leg_sign = np.array([1.0 if action == "SELL" else -1.0 for _, _, _, action in legs_def])
+
+        entry_ltp = np.where(leg_is_call, ce_ltp[rows, leg_cols], pe_ltp[rows, leg_cols])
+        exit_intrinsic = compute_intrinsic(leg_is_call, next_spots, grid[rows, leg_cols])
+        # Simulate a decrease in extrinsic value (time decay + random noise); LTP cannot be negative
+        exit_ltp = np.maximum(0.01, exit_intrinsic + rng.uniform(0.1, 0.5, entry_ltp.shape) * (entry_ltp - exit_intrinsic))
+        daily_pnl = ((entry_ltp - exit_ltp) * leg_sign * quantity).sum(axis=1)
+
+        trades_history = [{"date": d, "pnl": pnl} for d, pnl in zip(df_backtest.index[:-1].strftime("%Y-%m-%d"), daily_pnl.tolist())]
+
+        # Equity curve and drawdown from the daily P&L array; the peak starts at 0 (flat before the first trade)
+        cum_pnl = np.cumsum(daily_pnl)
+        peak_pnl = np.maximum.accumulate(np.maximum(cum_pnl, 0.0))
+        total_pnl = float(cum_pnl[-1])
+        win_rate = float((daily_pnl > 0).mean())
+        max_drawdown = float((peak_pnl - cum_pnl).max())
+
+        # pnl_history can run to thousands of rows; hand it straight to orjson rather than through jsonable_encoder
+        return ORJSONResponse({
             "total_pnl": round(total_pnl, 2),
             "win_rate": round(win_rate, 2),
-            "avg_pnl_per_trade": round(total_pnl / len(trades_history), 2) if trades_history else 0,
+            "avg_pnl_per_trade": round(total_pnl / len(trades_history), 2),
             "max_drawdown": round(max_drawdown, 2),
             "pnl_history": trades_history
-        }
+        })
     except Exception as e:
         logger.error(f"Backtest error: {e}")
         raise HTTPException(status_code=500, detail=f"Backtest error: {str(e)}")
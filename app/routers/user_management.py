@@ -1,19 +1,21 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
+import httpx
 from app.config import logger
 from app.models import UserDetailsInput
+from app.dependencies import get_http_client
 from app.utils.upstox_helpers import get_upstox_user_details
 
 router = APIRouter()
 
 @router.post("/user/details", summary="Retrieves authenticated user's profile, funds, holdings, and positions")
-async def get_user_details_endpoint(data: UserDetailsInput):
+async def get_user_details_endpoint(data: UserDetailsInput, http: httpx.AsyncClient = Depends(get_http_client)):
     """
     Fetches comprehensive details for the authenticated Upstox user,
     including profile information, available funds and margins, current holdings,
     open positions, and order/trade books.
     """
     try:
-        details = await get_upstox_user_details(data.access_token)
+        details = await get_upstox_user_details(http, data.access_token)
         return details
     except HTTPException as e:
         raise e
@@ -2,13 +2,24 @@ from fastapi import APIRouter, HTTPException
 import pandas as pd
 import numpy as np
 import requests
-import pickle
 from app.config import settings, logger
 from app.models import XGBInput, VolatilityHistoricalInput
-from app.utils.volatility_calcs import predict_garch_model, calculate_rolling_and_fixed_hv
+from app.utils.volatility_calcs import predict_garch_model, calculate_rolling_and_fixed_hv, load_xgb_model, load_nifty_history
 
 router = APIRouter()
 
+_XGB_FEATURES = tuple(XGBInput.model_fields)
+
+def _predict_xgb(xgb_model, data: XGBInput) -> float:
+    """Predicts from a single feature row without building a one-row DataFrame for xgboost models."""
+    if not hasattr(xgb_model, "get_booster"): # Not an xgboost sklearn model; keep the generic DataFrame path
+        return float(xgb_model.predict(pd.DataFrame([data.model_dump()]))[0])
+    # Order the row by the model's own training columns when it was fitted on a DataFrame; they have
+    # already been matched by name here, so xgboost's feature-name check is skipped
+    features = getattr(xgb_model, "feature_names_in_", None)
+    row = np.array([[getattr(data, f) for f in (_XGB_FEATURES if features is None else features)]], dtype=np.float64)
+    return float(xgb_model.predict(row, validate_features=False)[0])
+
 @router.post("/predict/xgboost", summary="Predicts volatility using an XGBoost model")
 def predict_vol_xgboost(data: XGBInput):
     """
@@ -16,12 +27,8 @@ def predict_vol_xgboost(data: XGBInput):
     Input features include ATM IV, Realized Vol, IVP, Event Impact Score, FII/DII Net Long, PCR, and VIX.
     """
     try:
-        response = requests.get(settings.XGBOOST_MODEL_URL)
-        response.raise_for_status()
-        xgb_model = pickle.loads(response.content)
-        df = pd.DataFrame([data.model_dump()])
-        pred = xgb_model.predict(df)
-        return {"predicted_volatility_7d (%)": round(float(pred[0]), 2)}
+        xgb_model = load_xgb_model(settings.XGBOOST_MODEL_URL)
+        return {"predicted_volatility_7d (%)": round(_predict_xgb(xgb_model, data), 2)}
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to download XGBoost model: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to download XGBoost model: {e}")
@@ -51,20 +58,15 @@ def get_historical_volatility(period: str = "all"):
     Query parameter `period` can be "7d", "30d", "1y", or "all".
     """
     try:
-        df = pd.read_csv(settings.NIFTY_HISTORICAL_DATA_URL)
-        df.columns = df.columns.str.strip()
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce", format="%d-%b-%Y")
-        df = df.dropna(subset=["Date"]).set_index("Date").sort_index()
-        if 'Close' not in df.columns:
-            raise ValueError(f"CSV file does not contain 'Close' column")
+        df = load_nifty_history(settings.NIFTY_HISTORICAL_DATA_URL) # Parsed once per hour, shared read-only
 
         periods_map = {"7d": 7, "30d": 30, "1y": 252}
 
         results = {}
         if period == "all":
-            for p_str, days in periods_map.items():
-                temp_results = calculate_rolling_and_fixed_hv(df, periods=[days])
-                results.update({f"hv_{p_str}": temp_results[f"hv_{days}d"]})
+            # One call computes the log returns once for every window
+            temp_results = calculate_rolling_and_fixed_hv(df, periods=list(periods_map.values()))
+            results.update({f"hv_{p_str}": temp_results[f"hv_{days}d"] for p_str, days in periods_map.items()})
         else:
             days = periods_map.get(period)
             if not days:
@@ -1,120 +1,124 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+from threading import Lock
 from app.config import logger
-
-# Global variable for previous OI (simplified state management for a single-user demo)
-prev_oi = {}
+from app.utils.kernels import compute_max_pain
+
+# Global variable for previous OI (simplified state management for a single-user demo): the last
+# seen OI per side, indexed by integer strike
+prev_oi = {"CE": pd.Series(dtype=np.int64), "PE": pd.Series(dtype=np.int64)}
+_prev_oi_lock = Lock() # The Series are replaced, never mutated, so only the merge needs guarding
+
+# (column suffix, section of the option payload, field, dtype) for each per-side column
+_LEG_FIELDS = (
+    ("LTP", "market_data", "ltp", np.float64),
+    ("IV", "option_greeks", "iv", np.float64),
+    ("Delta", "option_greeks", "delta", np.float64),
+    ("Theta", "option_greeks", "theta", np.float64),
+    ("Vega", "option_greeks", "vega", np.float64),
+    ("OI", "market_data", "oi", np.int64),
+    ("Volume", "market_data", "volume", np.int64),
+)
 
 def process_chain_data(data: list):
     """Processes raw option chain data into a structured DataFrame."""
     global prev_oi
-    rows = []
-    ce_oi_total = 0
-    pe_oi_total = 0
 
     try:
-        for r in data:
-            ce = r.get('call_options', {})
-            pe = r.get('put_options', {})
-            ce_md, pe_md = ce.get('market_data', {}), pe.get('market_data', {})
-            ce_gk, pe_gk = ce.get('option_greeks', {}), pe.get('option_greeks', {})
-            strike = r.get('strike_price', 0)
-
-            ce_oi_val = int(ce_md.get("oi", 0) or 0)
-            pe_oi_val = int(pe_md.get("oi", 0) or 0)
-
-            ce_oi_change = ce_oi_val - prev_oi.get(f"{strike}_CE", ce_oi_val)
-            pe_oi_change = pe_oi_val - prev_oi.get(f"{strike}_PE", pe_oi_val)
-
-            # Avoid division by zero for percentage change
-            ce_oi_change_pct = (ce_oi_change / prev_oi.get(f"{strike}_CE", 1) * 100) if prev_oi.get(f"{strike}_CE", 0) else 0
-            pe_oi_change_pct = (pe_oi_change / prev_oi.get(f"{strike}_PE", 1) * 100) if prev_oi.get(f"{strike}_PE", 0) else 0
-
-            strike_pcr = pe_oi_val / (ce_oi_val or 1)
-
-            row = {
-                "Strike": strike,
-                "CE_LTP": ce_md.get("ltp", 0.0) or 0.0,
-                "CE_IV": ce_gk.get("iv", 0.0) or 0.0,
-                "CE_Delta": ce_gk.get("delta", 0.0) or 0.0,
-                "CE_Theta": ce_gk.get("theta", 0.0) or 0.0,
-                "CE_Vega": ce_gk.get("vega", 0.0) or 0.0,
-                "CE_OI": ce_oi_val,
-                "CE_OI_Change": ce_oi_change,
-                "CE_OI_Change_Pct": ce_oi_change_pct,
-                "CE_Volume": ce_md.get("volume", 0) or 0,
-
-                "PE_LTP": pe_md.get("ltp", 0.0) or 0.0,
-                "PE_IV": pe_gk.get("iv", 0.0) or 0.0,
-                "PE_Delta": pe_gk.get("delta", 0.0) or 0.0,
-                "PE_Theta": pe_gk.get("theta", 0.0) or 0.0,
-                "PE_Vega": pe_gk.get("vega", 0.0) or 0.0,
-                "PE_OI": pe_oi_val,
-                "PE_OI_Change": pe_oi_change,
-                "PE_OI_Change_Pct": pe_oi_change_pct,
-                "PE_Volume": pe_md.get("volume", 0) or 0,
-                "Strike_PCR": strike_pcr,
-                "CE_Token": ce.get("instrument_key", ""),
-                "PE_Token": pe.get("instrument_key", "")
-            }
-            ce_oi_total += ce_oi_val
-            pe_oi_total += pe_oi_val
-            rows.append(row)
-
-        df = pd.DataFrame(rows).sort_values("Strike")
-
-        # Update previous OI for next run
-        for _, r in df.iterrows():
-            prev_oi[f"{int(r['Strike'])}_CE"] = int(r['CE_OI'])
-            prev_oi[f"{int(r['Strike'])}_PE"] = int(r['PE_OI'])
-
-        if not df.empty:
-            df['OI_Skew'] = (df['PE_OI'] - df['CE_OI']) / (df['PE_OI'] + df['CE_OI'] + 1)
-            valid_iv = df[(df['CE_IV'] > 0) & (df['PE_IV'] > 0)]
-            if len(valid_iv) >= 3:
-                # Calculate IV skew based on difference and a rolling mean for smoothing
-                iv_diff = (valid_iv['PE_IV'] - valid_iv['CE_IV']).abs()
-                df['IV_Skew_Slope'] = iv_diff.rolling(window=3, min_periods=1).mean().reindex(df.index, fill_value=0)
-            else:
-                df['IV_Skew_Slope'] = 0.0
+        # Build the frame column by column from typed arrays instead of a list of per-row dicts. Rows are put
+        # in strike order first (same ordering sort_values would give), so the frame never needs re-sorting.
+        strikes = np.array([r.get('strike_price', 0) or 0 for r in data], dtype=np.float64)
+        order = np.argsort(strikes, kind='quicksort')
+        strikes = strikes[order]
+        data = [data[i] for i in order]
+        strike_keys = strikes.astype(np.int64)
+        columns = {"Strike": strikes}
+        for side, key in (("CE", "call_options"), ("PE", "put_options")):
+            legs = [r.get(key) or {} for r in data]
+            for name, section, field, dtype in _LEG_FIELDS:
+                columns[f"{side}_{name}"] = np.array([(leg.get(section) or {}).get(field, 0) or 0 for leg in legs], dtype=dtype)
+
+            oi = columns[f"{side}_OI"]
+            prev = prev_oi[side].reindex(strike_keys).to_numpy(dtype=np.float64) # NaN where the strike is new
+            # Strikes seen for the first time report no change; avoid division by zero for percentage change
+            change = np.where(np.isnan(prev), 0, oi - np.nan_to_num(prev)).astype(np.int64)
+            has_prev = ~np.isnan(prev) & (prev != 0)
+            columns[f"{side}_OI_Change"] = change
+            # Divide only where there is a previous OI; the preset zeros cover the rest without temporaries
+            change_pct = np.zeros(len(strikes))
+            np.divide(change, prev, out=change_pct, where=has_prev)
+            columns[f"{side}_OI_Change_Pct"] = change_pct * 100
+            columns[f"{side}_Token"] = [leg.get("instrument_key", "") for leg in legs]
+
+        ce_oi, pe_oi = columns["CE_OI"], columns["PE_OI"]
+        # Strikes without call OI fall back to dividing by 1, i.e. Strike_PCR = PE_OI
+        columns["Strike_PCR"] = pe_oi.astype(np.float64)
+        np.divide(pe_oi, ce_oi, out=columns["Strike_PCR"], where=ce_oi != 0)
+
+        # Keep the established column order: CE block, PE block, PCR, tokens, then the skew columns
+        ordered = ["Strike"] + [f"{side}_{name}" for side in ("CE", "PE") for name in ("LTP", "IV", "Delta", "Theta", "Vega", "OI", "OI_Change", "OI_Change_Pct", "Volume")]
+        ordered += ["Strike_PCR", "CE_Token", "PE_Token"]
+        if len(strikes):
+            columns["OI_Skew"] = (pe_oi - ce_oi) / (pe_oi + ce_oi + 1)
+            ce_iv, pe_iv = columns["CE_IV"], columns["PE_IV"]
+            valid_iv = (ce_iv > 0) & (pe_iv > 0)
+            iv_skew_slope = np.zeros(len(strikes))
+            if valid_iv.sum() >= 3:
+                # Calculate IV skew based on difference and a 3-strike trailing mean (over valid strikes) for smoothing
+                iv_diff = np.abs(pe_iv[valid_iv] - ce_iv[valid_iv])
+                window = np.minimum(np.arange(1, len(iv_diff) + 1), 3)
+                iv_skew_slope[valid_iv] = np.convolve(iv_diff, np.ones(3))[:len(iv_diff)] / window
+            columns["IV_Skew_Slope"] = iv_skew_slope
+            ordered += ["OI_Skew", "IV_Skew_Slope"]
+        # One construction with every column, rather than inserting derived columns into a built frame
+        df = pd.DataFrame({col: columns[col] for col in ordered})
+
+        ce_oi_total = int(ce_oi.sum())
+        pe_oi_total = int(pe_oi.sum())
+
+        # Update previous OI for next run; strikes missing from this poll keep their last value
+        with _prev_oi_lock:
+            for side in ("CE", "PE"):
+                latest = pd.concat([prev_oi[side], pd.Series(columns[f"{side}_OI"], index=strike_keys)])
+                prev_oi[side] = latest[~latest.index.duplicated(keep='last')]
         return df, ce_oi_total, pe_oi_total
     except Exception as e:
         logger.error(f"Option chain processing error: {e}")
         return pd.DataFrame(), 0, 0
 
+def find_atm_index(strikes: np.ndarray, spot: float) -> int:
+    """Position of the strike nearest to spot in an ascending strike array (lower strike on ties)."""
+    i = int(np.searchsorted(strikes, spot))
+    if i == len(strikes) or (i > 0 and spot - strikes[i - 1] <= strikes[i] - spot):
+        return i - 1
+    return i
+
 def calculate_metrics_data(df: pd.DataFrame, ce_oi_total: int, pe_oi_total: int, spot: float):
     """Calculates key option chain metrics like PCR, Max Pain, Straddle Price, ATM Strike, ATM IV."""
     try:
         if df.empty:
             return 0, 0, 0, 0, 0
 
+        # Pull every column the metrics need once and work positionally on the arrays
+        strikes = df['Strike'].to_numpy(dtype=np.float64)
+        ce_oi, pe_oi = df['CE_OI'].to_numpy(dtype=np.float64), df['PE_OI'].to_numpy(dtype=np.float64)
+        ce_ltp, pe_ltp = df['CE_LTP'].to_numpy(), df['PE_LTP'].to_numpy()
+        ce_iv, pe_iv = df['CE_IV'].to_numpy(), df['PE_IV'].to_numpy()
+
         # Find ATM strike
-        atm = df.iloc[(df['Strike'] - spot).abs().argsort()[:1]]
-        atm_strike = atm['Strike'].values[0] if not atm.empty else spot
+        atm_idx = find_atm_index(strikes, spot) # process_chain_data returns the chain sorted by strike
+        atm_strike = strikes[atm_idx]
 
         # Overall PCR
         pcr = pe_oi_total / (ce_oi_total or 1)
 
-        # Max Pain Calculation
-        min_pain = float('inf')
-        max_pain = spot
-        for strike in df['Strike']:
-            pain = 0
-            for s_call in df['Strike']:
-                if s_call > strike:
-                    pain += df[df['Strike'] == s_call]['CE_OI'].iloc[0] * (s_call - strike)
-            for s_put in df['Strike']:
-                if s_put < strike:
-                    pain += df[df['Strike'] == s_put]['PE_OI'].iloc[0] * (strike - s_put)
-
-            if pain < min_pain:
-                min_pain = pain
-                max_pain = strike
+        # Max Pain
+        max_pain = compute_max_pain(strikes, ce_oi, pe_oi)
 
         # Straddle Price and ATM IV
-        straddle_price = float(atm['CE_LTP'].values[0] + atm['PE_LTP'].values[0]) if not atm.empty else 0
-        atm_iv = (atm['CE_IV'].values[0] + atm['PE_IV'].values[0]) / 2 if not atm.empty else 0
+        straddle_price = float(ce_ltp[atm_idx] + pe_ltp[atm_idx])
+        atm_iv = (ce_iv[atm_idx] + pe_iv[atm_idx]) / 2
 
         return pcr, max_pain, straddle_price, atm_strike, atm_iv
     except Exception as e:
@@ -129,19 +133,27 @@ def build_strategy_legs(option_chain_data: list, spot_price: float, strategy_nam
         if not strikes:
             raise ValueError("No strikes found in option chain data")
 
+        # Nearest-strike selection by binary search over the sorted, distinct strikes (lower strike on ties,
+        # as with the ascending chain Upstox returns)
+        sorted_strikes = sorted(set(strikes))
+        strike_arr = np.array(sorted_strikes, dtype=np.float64)
+
+        def nearest_strike(target):
+            return sorted_strikes[find_atm_index(strike_arr, target)]
+
         # Find the ATM strike based on spot price
-        atm_strike = min(strikes, key=lambda x: abs(x - spot_price))
+        atm_strike = nearest_strike(spot_price)
 
         legs = []
 
-        def get_instrument_key_and_ltp(strike, opt_type):
-            for leg_data in option_chain_data:
-                if leg_data.get('strike_price') == strike:
-                    if opt_type == 'CE' and 'call_options' in leg_data:
-                        return leg_data['call_options'].get('instrument_key'), leg_data['call_options'].get('market_data', {}).get('ltp', 0.0)
-                    elif opt_type == 'PE' and 'put_options' in leg_data:
-                        return leg_data['put_options'].get('instrument_key'), leg_data['put_options'].get('market_data', {}).get('ltp', 0.0)
-            return None, 0.0
+        # Flatten the chain once into (strike, side) -> (instrument_key, ltp) so each leg is a single
+        # dict lookup; the first row carrying that side wins, as with the previous linear scan
+        options_by_strike = {}
+        for leg_data in option_chain_data:
+            for side, key in (("CE", "call_options"), ("PE", "put_options")):
+                if key in leg_data and (leg_data.get('strike_price'), side) not in options_by_strike:
+                    option = leg_data[key]
+                    options_by_strike[(leg_data.get('strike_price'), side)] = (option.get('instrument_key'), option.get('market_data', {}).get('ltp', 0.0))
 
         s = strategy_name.lower()
         if s == "iron_fly":
@@ -168,8 +180,8 @@ def build_strategy_legs(option_chain_data: list, spot_price: float, strategy_nam
             ]
             # Adjust strikes for bull put spread logic: Sell higher strike put, Buy lower strike put
             # Let's redefine for clarity: Sell OTM (e.g., atm_strike - 50), Buy further OTM (atm_strike - 100)
-            target_sell_strike = min(strikes, key=lambda x: abs(x - (spot_price - otm_distance)))
-            target_buy_strike = min(strikes, key=lambda x: abs(x - (spot_price - 2 * otm_distance)))
+            target_sell_strike = nearest_strike(spot_price - otm_distance)
+            target_buy_strike = nearest_strike(spot_price - 2 * otm_distance)
             legs_def = [
                 (target_sell_strike, "PE", "SELL"),
                 (target_buy_strike, "PE", "BUY"),
@@ -177,8 +189,8 @@ def build_strategy_legs(option_chain_data: list, spot_price: float, strategy_nam
         elif s == "bear_call_spread":
             # Sell OTM Call, Buy Far OTM Call
             # Let's redefine for clarity: Sell OTM (e.g., atm_strike + 50), Buy further OTM (atm_strike + 100)
-            target_sell_strike = min(strikes, key=lambda x: abs(x - (spot_price + otm_distance)))
-            target_buy_strike = min(strikes, key=lambda x: abs(x - (spot_price + 2 * otm_distance)))
+            target_sell_strike = nearest_strike(spot_price + otm_distance)
+            target_buy_strike = nearest_strike(spot_price + 2 * otm_distance)
             legs_def = [
                 (target_sell_strike, "CE", "SELL"),
                 (target_buy_strike, "CE", "BUY"),
@@ -188,7 +200,7 @@ def build_strategy_legs(option_chain_data: list, spot_price: float, strategy_nam
 
 
         for strike, opt_type, action in legs_def:
-            instrument_key, ltp = get_instrument_key_and_ltp(strike, opt_type)
+            instrument_key, ltp = options_by_strike.get((strike, opt_type), (None, 0.0))
             if instrument_key:
                 legs.append({
                     "instrument_key": instrument_key,
@@ -0,0 +1,66 @@
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError: # numba is optional; fall back to the equivalent NumPy kernels
+    NUMBA_AVAILABLE = False
+
+if NUMBA_AVAILABLE:
+    # Serial on purpose: requests already run concurrently on the server's threadpool, and a
+    # chain is at most a few hundred strikes, so parallel launch overhead would dominate.
+    @njit(cache=True)
+    def compute_max_pain(strikes, ce_oi, pe_oi):
+        """Max-pain strike: the candidate with the least OI-weighted distance to calls above and puts below it.
+
+        strikes must be ascending. One downward sweep accumulates the calls, one upward sweep the puts.
+        """
+        n = strikes.shape[0]
+        pain = np.empty(n)
+        oi = 0.0
+        oi_strike = 0.0
+        for i in range(n - 1, -1, -1):
+            oi += ce_oi[i]
+            oi_strike += ce_oi[i] * strikes[i]
+            pain[i] = oi_strike - strikes[i] * oi
+        oi = 0.0
+        oi_strike = 0.0
+        for i in range(n):
+            oi += pe_oi[i]
+            oi_strike += pe_oi[i] * strikes[i]
+            pain[i] += strikes[i] * oi - oi_strike
+        return strikes[np.argmin(pain)]
+
+    @njit(cache=True)
+    def compute_intrinsic(is_call, spots, strikes):
+        """Intrinsic value of a [day, column] strike grid; is_call flags each column, spots gives each day."""
+        days, cols = strikes.shape
+        out = np.empty((days, cols))
+        for i in range(days):
+            for j in range(cols):
+                diff = spots[i] - strikes[i, j] if is_call[j] else strikes[i, j] - spots[i]
+                out[i, j] = diff if diff > 0 else 0.0
+        return out
+else:
+    def compute_max_pain(strikes, ce_oi, pe_oi):
+        """Max-pain strike: the candidate with the least OI-weighted distance to calls above and puts below it.
+
+        strikes must be ascending. Uses prefix sums, so it is O(n) rather than a pairwise matrix.
+        """
+        ce_above = np.cumsum(ce_oi[::-1])[::-1] # OI of calls at or above each strike
+        ce_strike_above = np.cumsum((ce_oi * strikes)[::-1])[::-1]
+        pe_below = np.cumsum(pe_oi) # OI of puts at or below each strike
+        pe_strike_below = np.cumsum(pe_oi * strikes)
+        pain = (ce_strike_above - strikes * ce_above) + (strikes * pe_below - pe_strike_below)
+        return strikes[pain.argmin()]
+
+    def compute_intrinsic(is_call, spots, strikes):
+        """Intrinsic value of a [day, column] strike grid; is_call flags each column, spots gives each day."""
+        moneyness = spots[:, None] - strikes
+        return np.maximum(np.where(is_call, moneyness, -moneyness), 0.0)
+
+def warm_kernels():
+    """Compiles (or loads from the on-disk cache) the JIT kernels so no request pays for it."""
+    strikes = np.array([100.0, 150.0, 200.0])
+    compute_max_pain(strikes, np.ones(3), np.ones(3))
+    compute_intrinsic(np.array([True, False, True]), np.array([150.0]), strikes[None, :])
@@ -1,22 +1,28 @@
+import numpy as np
 from app.models import Trade
 from app.config import logger
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import Connection, select, func, case
 
-def calculate_discipline_score(trades: list[Trade]):
+def calculate_discipline_score(db: Connection):
     """Calculates a trading discipline score."""
     try:
-        if not trades:
+        total_trades, high_risk_trades, losing_trades = db.execute(
+            select(
+                func.count(Trade.id),
+                func.coalesce(func.sum(case((Trade.regime_score < 3, 1), else_=0)), 0), # Assuming a score < 3 is high risk
+                func.coalesce(func.sum(case((Trade.pnl < 0, 1), else_=0)), 0),
+            )
+        ).one()
+        if not total_trades:
             return {"score": 100, "violations": []}
+
+        # More than 3 trades a day is overtrading
+        trade_day = func.date(Trade.timestamp)
+        overtrading_stmt = select(trade_day).group_by(trade_day).having(func.count(Trade.id) > 3)
+        overtrading_days = db.execute(select(func.count()).select_from(overtrading_stmt.subquery())).scalar_one()
+
         violations = []
-        total_trades = len(trades)
-        high_risk_trades = sum(1 for t in trades if t.regime_score < 3) # Assuming a score < 3 is high risk
-        daily_trades = {}
-        for t in trades:
-            date = t.timestamp.date()
-            daily_trades[date] = daily_trades.get(date, 0) + 1
-        overtrading_days = sum(1 for count in daily_trades.values() if count > 3) # More than 3 trades a day is overtrading
-        losing_trades = sum(1 for t in trades if t.pnl < 0)
         score = 100
         if high_risk_trades / total_trades > 0.2:
             violations.append("Too many high-risk trades (low regime score)")
@@ -32,3 +38,16 @@ def calculate_discipline_score(trades: list[Trade]):
     except Exception as e:
         logger.error(f"Discipline score calculation error: {e}")
         raise HTTPException(status_code=500, detail=f"Discipline score calculation error: {str(e)}")
+
+def check_risk_batch(estimated_loss, max_loss_allowed, daily_pnl, max_daily_limit, iv_rv_ratio):
+    """Branchless risk check over arrays of candidate trades.
+
+    Returns the volatility-adjusted loss, the projected daily P&L, and boolean masks for
+    max-loss and daily-limit breaches.
+    """
+    vol_factor = 1.0 + np.maximum(iv_rv_ratio - 1, 0) * 0.5 # Only IV > RV inflates the loss estimate
+    adjusted_loss = estimated_loss * vol_factor
+    potential_daily_pnl = daily_pnl - adjusted_loss
+    max_loss_breached = adjusted_loss > max_loss_allowed
+    daily_limit_breached = potential_daily_pnl < -np.abs(max_daily_limit)
+    return adjusted_loss, potential_daily_pnl, max_loss_breached, daily_limit_breached
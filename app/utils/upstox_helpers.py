@@ -1,12 +1,18 @@
 import upstox_client
-from upstox_client import Configuration, ApiClient, OptionsApi, OrderApiV3
+from upstox_client import Configuration, ApiClient, OrderApiV3
 from upstox_client.rest import ApiException
-import requests
-import json
+import asyncio
+import httpx
+import orjson
 import time
-import pandas as pd
-from datetime import datetime, timedelta
-import retrying
+from datetime import date
+import urllib3
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from functools import lru_cache, wraps
+from threading import Lock
+from types import MappingProxyType
+from cachetools import TTLCache
+from fastapi import HTTPException
 from app.config import settings, logger
 
 # Upstox SDK client configuration
@@ -15,86 +21,273 @@ def get_upstox_config(access_token: str):
     configuration.access_token = access_token
     return configuration
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
-def fetch_expiry(options_api_client: OptionsApi, instrument_key: str):
-    """Fetches nearest expiry date for a given instrument key."""
+# REST endpoints used over the shared httpx client
+_OPTION_CONTRACT_URL = f"{settings.UPSTOX_BASE_URL}/option/contract"
+_OPTION_CHAIN_URL = f"{settings.UPSTOX_BASE_URL}/option/chain"
+_DEPTH_URL = f"{settings.UPSTOX_BASE_URL}/market-quote/depth"
+_PROFILE_URL = f"{settings.UPSTOX_BASE_URL}/user/profile"
+_FUNDS_URL = f"{settings.UPSTOX_BASE_URL}/user/get-funds-and-margin"
+_HOLDINGS_URL = f"{settings.UPSTOX_BASE_URL}/portfolio/long-term-holdings"
+_POSITIONS_URL = f"{settings.UPSTOX_BASE_URL}/portfolio/short-term-positions"
+_ORDER_BOOK_URL = f"{settings.UPSTOX_BASE_URL}/order/retrieve-all"
+_TRADES_FOR_DAY_URL = f"{settings.UPSTOX_BASE_URL}/order/trades/get-trades-for-day"
+
+@lru_cache(maxsize=1024)
+def _auth_headers(access_token: str):
+    """Read-only REST headers for an access token, built once and shared by every request using it."""
+    return MappingProxyType({"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"})
+
+# Every ApiClient starts its own ThreadPool and urllib3 connection pool, so keep one per access token
+_api_clients = TTLCache(maxsize=256, ttl=3600)
+_api_clients_lock = Lock()
+
+def get_upstox_api_client(access_token: str) -> ApiClient:
+    """Returns the shared, connection-pooled SDK ApiClient for an access token."""
+    with _api_clients_lock:
+        api_client = _api_clients.get(access_token)
+        if api_client is None:
+            api_client = _api_clients[access_token] = ApiClient(get_upstox_config(access_token))
+        return api_client
+
+def close_upstox_api_clients():
+    """Drops the cached SDK clients so their thread and connection pools are released."""
+    with _api_clients_lock:
+        _api_clients.clear()
+
+# Retry only what can succeed on a second attempt: rate limiting, transient 5xx and network failures.
+# Other 4xx responses fail immediately. Backoff is exponential with jitter, or the server's Retry-After.
+_RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+_backoff = wait_exponential_jitter(initial=0.5, max=8, jitter=0.5)
+
+def _status_of(e: BaseException):
+    if isinstance(e, ApiException):
+        return e.status
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    return None
+
+def _headers_of(e: BaseException):
+    if isinstance(e, ApiException):
+        return e.headers or {}
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.headers
+    return {}
+
+def _is_network_error(e: BaseException) -> bool:
+    return isinstance(e, (httpx.TransportError, urllib3.exceptions.HTTPError))
+
+class _CircuitBreaker:
+    """Fails Upstox calls fast after repeated outage errors (5xx or network). Once the cool-down has passed a
+    single probe call is let through: its success closes the circuit again, another outage re-opens it."""
+    def __init__(self, fail_max: int, reset_timeout: float):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            # A probe that never reports back (e.g. cancelled) frees the slot after another cool-down
+            probe_free = self._probe_started_at is None or now - self._probe_started_at >= self.reset_timeout
+            if now - self._opened_at >= self.reset_timeout and probe_free:
+                self._probe_started_at = now
+                return
+            raise HTTPException(status_code=503, detail="Upstox API is currently failing; retry shortly.")
+
+    def record(self, error: BaseException = None):
+        with self._lock:
+            if error is not None and ((_status_of(error) or 0) >= 500 or _is_network_error(error)):
+                self._failures += 1
+                if self._failures >= self.fail_max:
+                    self._opened_at = time.monotonic() # (Re)open and wait for the next probe
+                    self._probe_started_at = None
+            else:
+                # Any response other than an outage error shows Upstox is serving again
+                self._failures = 0
+                self._opened_at = None
+                self._probe_started_at = None
+
+_upstox_breaker = _CircuitBreaker(fail_max=5, reset_timeout=30)
+
+class _RateLimiter:
+    """Token bucket shared by every outbound Upstox call, so bursts (and their retries) stay under the rate limit."""
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1.0) # Up to one second's worth of calls may go out back to back
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how long the caller must wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1 # May go negative: later callers queue behind earlier reservations
+            return max(0.0, -self._tokens / self.rate)
+
+_upstox_limiter = _RateLimiter(settings.UPSTOX_MAX_REQUESTS_PER_SECOND)
+# The bucket caps the start rate; this caps how many slow calls (and SDK worker threads) pile up at once
+_upstox_slots = asyncio.Semaphore(settings.UPSTOX_MAX_CONCURRENCY)
+
+def _paced(func):
+    """Runs each attempt of an Upstox call through the rate limiter and the concurrency cap."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        delay = _upstox_limiter.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        async with _upstox_slots:
+            return await func(*args, **kwargs)
+    return wrapper
+
+def _circuit_guarded(func):
+    """Checks the circuit breaker before a logical Upstox call and reports its final outcome, once, after any retries."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        _upstox_breaker.before_call()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            _upstox_breaker.record(e)
+            raise
+        _upstox_breaker.record()
+        return result
+    return wrapper
+
+def _upstox_retry(statuses: frozenset, network_errors: bool):
+    """Builds a retry decorator for async Upstox calls. Every attempt is paced; the breaker sees the call as a whole."""
+    def should_retry(e: BaseException) -> bool:
+        status = _status_of(e)
+        if status is not None:
+            return status in statuses
+        return network_errors and _is_network_error(e)
+
+    def wait(retry_state) -> float:
+        retry_after = _headers_of(retry_state.outcome.exception()).get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), 8.0)
+        return _backoff(retry_state)
+
+    policy = retry(retry=retry_if_exception(should_retry), stop=stop_after_attempt(3), wait=wait, reraise=True)
+    return lambda func: _circuit_guarded(policy(_paced(func)))
+
+upstox_retry = _upstox_retry(_RETRYABLE_STATUSES, network_errors=True)
+# Orders are not idempotent: a 5xx or dropped connection may still have placed the order, so only a 429
+# (rejected before processing) is retried
+upstox_order_retry = _upstox_retry(frozenset({429}), network_errors=False)
+
+def translate_upstox_errors(func):
+    """Turns Upstox HTTP failures escaping a helper into HTTPExceptions: the upstream status for an error
+    response, 503 when Upstox could not be reached."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=e.response.status_code, detail=f"Upstox API error: {e.response.text}")
+        except httpx.TransportError as e:
+            raise HTTPException(status_code=503, detail=f"Upstox API unreachable: {e}")
+    return wrapper
+
+@upstox_retry
+async def _get_data(client: httpx.AsyncClient, access_token: str, url: str, params: dict = None):
+    """GETs an Upstox REST endpoint over the shared client and returns the decoded 'data' field."""
+    res = await client.get(url, headers=_auth_headers(access_token), params=params)
+    res.raise_for_status()
+    return orjson.loads(res.content).get("data")
+
+@translate_upstox_errors
+async def fetch_expiry_dates(client: httpx.AsyncClient, access_token: str, instrument_key: str):
+    """Fetches the sorted, distinct contract expiry dates (as ISO "YYYY-MM-DD" strings) for a given instrument key."""
     try:
-        response = options_api_client.get_option_contracts(instrument_key=instrument_key)
-        contracts = response.to_dict().get("data", [])
-        expiry_dates = set()
-        for contract in contracts:
-            exp = contract.get("expiry")
-            if isinstance(exp, str):
-                exp = datetime.strptime(exp, "%Y-%m-%d")
-            expiry_dates.add(exp)
-        expiry_list = sorted(expiry_dates)
-        today = datetime.now()
-        valid_expiries = [e.strftime("%Y-%m-%d") for e in expiry_list if e >= today]
-        return valid_expiries[0] if valid_expiries else None
-    except ApiException as e:
-        logger.error(f"Expiry fetch failed for {instrument_key}: {e.body}")
+        contracts = await _get_data(client, access_token, _OPTION_CONTRACT_URL, {"instrument_key": instrument_key}) or []
+        # ISO date strings sort chronologically, so there is no need to round-trip them through strptime
+        return sorted({c["expiry"][:10] for c in contracts if c.get("expiry")})
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Expiry fetch failed for {instrument_key}: {e.response.text}")
         raise
     except Exception as e:
         logger.error(f"Expiry fetch error for {instrument_key}: {e}")
         raise
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
-def fetch_option_chain_raw(options_api_client: OptionsApi, instrument_key: str, expiry_date: str):
+def nearest_expiry(expiry_dates: list):
+    """Picks the nearest expiry that has not passed yet from a sorted list of ISO expiry dates."""
+    # Strictly after today: an expiry's date (midnight) is already behind the current time on expiry day
+    today = date.today().isoformat()
+    return next((e for e in expiry_dates if e > today), None)
+
+async def fetch_expiry(client: httpx.AsyncClient, access_token: str, instrument_key: str):
+    """Fetches nearest expiry date for a given instrument key."""
+    return nearest_expiry(await fetch_expiry_dates(client, access_token, instrument_key))
+
+@translate_upstox_errors
+async def fetch_option_chain_raw(client: httpx.AsyncClient, access_token: str, instrument_key: str, expiry_date: str):
     """Fetches raw option chain data."""
     try:
-        res = options_api_client.get_put_call_option_chain(instrument_key=instrument_key, expiry_date=expiry_date)
-        return res.to_dict().get('data', [])
-    except ApiException as e:
-        logger.error(f"Option chain fetch failed for {instrument_key} on {expiry_date}: {e.body}")
+        params = {"instrument_key": instrument_key, "expiry_date": expiry_date}
+        return await _get_data(client, access_token, _OPTION_CHAIN_URL, params) or []
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Option chain fetch failed for {instrument_key} on {expiry_date}: {e.response.text}")
         raise
     except Exception as e:
         logger.error(f"Option chain fetch error for {instrument_key} on {expiry_date}: {e}")
         raise
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
-def get_market_depth(access_token: str, instrument_token: str):
-    """Fetches market depth for a given instrument token using direct requests."""
+@upstox_retry
+async def get_market_depth(client: httpx.AsyncClient, access_token: str, instrument_token: str):
+    """Fetches market depth for a given instrument token over the shared async HTTP client."""
     try:
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-        url = f"{settings.UPSTOX_BASE_URL}/market-quote/depth"
         params = {"instrument_key": instrument_token}
-        res = requests.get(url, headers=headers, params=params)
+        res = await client.get(_DEPTH_URL, headers=_auth_headers(access_token), params=params)
         res.raise_for_status()
-        data = res.json().get('data', {}).get(instrument_token, {}).get('depth', {})
+        data = orjson.loads(res.content).get('data', {}).get(instrument_token, {}).get('depth', {})
         bid_volume = sum(item.get('quantity', 0) for item in data.get('buy', []))
         ask_volume = sum(item.get('quantity', 0) for item in data.get('sell', []))
         return {"bid_volume": bid_volume, "ask_volume": ask_volume}
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"HTTP Request error for depth fetch for {instrument_token}: {e}")
         raise
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"JSON decode error for depth fetch for {instrument_token}: {e}")
         raise
     except Exception as e:
         logger.error(f"Depth fetch error for {instrument_token}: {e}")
         raise
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
+# Fields shared by every strategy leg order. The v3 request model takes the plain string codes.
+_ORDER_DEFAULTS = MappingProxyType({
+    "product": "I", # Intraday for now, adjust as needed
+    "order_type": "MARKET",
+    "validity": "DAY",
+    "is_amo": False,
+})
+
+@upstox_order_retry
 async def place_order_for_leg(access_token: str, leg: dict):
     """Places a single order leg via Upstox API."""
     try:
-        config = get_upstox_config(access_token)
-        api_client = ApiClient(config)
+        api_client = get_upstox_api_client(access_token)
         order_api_v3 = OrderApiV3(api_client)
 
         place_order_request_v3 = upstox_client.PlaceOrderV3Request(
+            **_ORDER_DEFAULTS,
             instrument_token=leg["instrument_key"],
             quantity=leg["quantity"],
-            product=upstox_client.PlaceOrderV3Request.ProductEnum.I, # Intraday for now, adjust as needed
-            order_type=upstox_client.PlaceOrderV3Request.OrderTypeEnum.MARKET,
-            transaction_type=upstox_client.PlaceOrderV3Request.TransactionTypeEnum.BUY if leg["action"] == "BUY" else upstox_client.PlaceOrderV3Request.TransactionTypeEnum.SELL,
+            transaction_type="BUY" if leg["action"] == "BUY" else "SELL",
             price=leg.get("price", 0.0), # Only for LIMIT orders, 0 for MARKET
             trigger_price=leg.get("trigger_price", 0.0),
-            validity=upstox_client.PlaceOrderV3Request.ValidityEnum.DAY,
             disclosed_quantity=leg.get("disclosed_quantity", 0),
             tag=leg.get("tag", "volguard")
         )
-        response = await order_api_v3.place_order(place_order_request_v3) # Use await here
+        # The SDK call is blocking; run it on a worker thread so concurrent legs don't stall the event loop
+        response = await asyncio.to_thread(order_api_v3.place_order, place_order_request_v3)
         return response.to_dict().get('data', {})
     except ApiException as e:
         logger.error(f"Order failed for {leg['instrument_key']}: Status {e.status}, Body: {e.body}")
@@ -103,18 +296,17 @@ async def place_order_for_leg(access_token: str, leg: dict):
         logger.error(f"Order failed for {leg['instrument_key']}: {e}")
         raise
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
-def fetch_trade_pnl(access_token: str, order_id: str):
-    """Fetches P&L for a given order ID using direct requests."""
+async def fetch_trade_pnl(client: httpx.AsyncClient, access_token: str, order_ids: list):
+    """Fetches the combined P&L of a batch of order IDs with one trades-for-day request."""
+    # Runs after live orders went out, so every failure (an open circuit included) reports 0 instead of raising
     try:
-        headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-        url = f"{settings.UPSTOX_BASE_URL}/order/trades?order_id={order_id}"
-        res = requests.get(url, headers=headers)
-        res.raise_for_status()
-        trades = res.json().get('data', [])
+        trades = await _get_data(client, access_token, _TRADES_FOR_DAY_URL) or []
 
+        wanted = set(order_ids)
         total_pnl = 0
         for trade in trades:
+            if trade.get('order_id') not in wanted:
+                continue
             # Note: 'realized_pnl' is not standard for individual trade API.
             # This is a simplification. For actual P&L, you usually calculate from buy/sell avg prices.
             # Assuming for demo purposes that Upstox provides some P&L if trade is closed.
@@ -124,39 +316,45 @@ def fetch_trade_pnl(access_token: str, order_id: str):
 
         return total_pnl
     except Exception as e:
-        logger.error(f"P&L fetch failed for order {order_id}: {e}")
+        logger.error(f"P&L fetch failed for orders {order_ids}: {e}")
         return 0
 
-# @retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
-async def get_upstox_user_details(access_token: str):
-    """Fetches comprehensive user details from Upstox APIs."""
+@translate_upstox_errors
+async def get_upstox_user_details(client: httpx.AsyncClient, access_token: str):
+    """Fetches comprehensive user details from Upstox APIs, issuing the six reads concurrently."""
     try:
-        config = get_upstox_config(access_token)
-        api_client = ApiClient(config)
-
-        user_api = upstox_client.UserApi(api_client)
-        portfolio_api = upstox_client.PortfolioApi(api_client)
-        order_api = upstox_client.OrderApi(api_client)
+        # Total latency is the slowest call rather than the sum of all six
+        results = await asyncio.gather(
+            *[_get_data(client, access_token, url) for url in (_PROFILE_URL, _FUNDS_URL, _HOLDINGS_URL, _POSITIONS_URL, _ORDER_BOOK_URL, _TRADES_FOR_DAY_URL)],
+            return_exceptions=True,
+        )
+        profile, funds, holdings, positions, all_orders, trades_for_day = results
 
-        profile_data = user_api.get_profile(api_version="v2").to_dict().get('data', {})
-        funds_data = user_api.get_user_fund_margin(api_version="v2").to_dict().get('data', {})
-        holdings_data = portfolio_api.get_holdings(api_version="v2").to_dict().get('data', [])
-        positions_data = portfolio_api.get_positions(api_version="v2").to_dict().get('data', [])
-        all_orders_data = order_api.get_order_book(api_version="v2").to_dict().get('data', [])
-        trades_for_day_data = order_api.get_trade_history(api_version="v2").to_dict().get('data', [])
+        # Funds are not served during Upstox's nightly maintenance window (UDAPI100072); report them as empty
+        funds_unavailable = isinstance(funds, httpx.HTTPStatusError) and "UDAPI100072" in funds.response.text
+        if funds_unavailable:
+            logger.warning("Upstox funds API is unavailable right now (UDAPI100072); returning empty funds.")
+        for result in results:
+            if isinstance(result, Exception) and not (result is funds and funds_unavailable):
+                raise result
 
         return {
-            "profile": profile_data,
-            "funds": funds_data,
-            "holdings": holdings_data,
-            "positions": positions_data,
-            "orders": all_orders_data,
-            "trades": trades_for_day_data
+            "profile": profile or {},
+            "funds": {} if funds_unavailable else funds or {},
+            "holdings": holdings or [],
+            "positions": positions or [],
+            "orders": all_orders or [],
+            "trades": trades_for_day or []
         }
 
-    except ApiException as e:
-        logger.error(f"Upstox API Error fetching user details: Status {e.status}, Body: {e.body}")
-        raise HTTPException(status_code=500, detail=f"User details endpoint error: {e.body}")
+    except HTTPException:
+        raise
+    except httpx.HTTPStatusError as e:
+        logger.error(f"Upstox API Error fetching user details: Status {e.response.status_code}, Body: {e.response.text}")
+        raise
+    except httpx.TransportError as e:
+        logger.error(f"Upstox API unreachable fetching user details: {e}")
+        raise
     except Exception as e:
         import traceback
         logger.error(f"User details fetch failed: {e}")
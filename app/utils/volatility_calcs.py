@@ -1,37 +1,126 @@
+import io
+import os
+import hashlib
+from pathlib import Path
 import pandas as pd
 import numpy as np
 import requests
+import pickle
+from threading import Lock
 from arch import arch_model
+from cachetools import TTLCache, cached
 from app.config import settings, logger
-import retrying
 from fastapi import HTTPException
 
-@retrying.retry(stop_max_attempt_number=3, wait_fixed=2000)
+_history_session = requests.Session() # Pooled connection for history downloads
+
+def _read_history_csv(source) -> pd.DataFrame:
+    """Parses a history CSV (path or buffer) with pyarrow; the upstream headers carry stray whitespace."""
+    df = pd.read_csv(source, engine="pyarrow")
+    df.columns = df.columns.str.strip()
+    return df
+
+def _clean_history(df: pd.DataFrame) -> pd.DataFrame:
+    """Reduces a raw history frame to a date-indexed, sorted 'Close' frame."""
+    if 'Date' not in df.columns or 'Close' not in df.columns:
+        raise ValueError(f"CSV file must contain 'Date' and 'Close' columns. Available columns: {list(df.columns)}")
+    df = df[["Date", "Close"]]
+    df["Date"] = pd.to_datetime(df["Date"], errors="coerce", format="%d-%b-%Y")
+    return df.dropna(subset=["Date"]).set_index("Date").sort_index()
+
+def _fetch_remote_history(url: str) -> pd.DataFrame:
+    """Fetches a remote history CSV, revalidating a local Parquet snapshot by ETag.
+
+    An unchanged file (304) is read back from the snapshot instead of being downloaded and re-parsed;
+    if the server is unreachable the last snapshot is served.
+    """
+    cache_dir = Path(settings.HISTORY_CACHE_DIR)
+    stem = hashlib.sha1(url.encode()).hexdigest()[:16]
+    snapshot, etag_file = cache_dir / f"nifty_{stem}.parquet", cache_dir / f"nifty_{stem}.etag"
+    has_snapshot = snapshot.exists() and etag_file.exists()
+
+    headers = {"If-None-Match": etag_file.read_text()} if has_snapshot else {}
+    try:
+        response = _history_session.get(url, headers=headers, timeout=30)
+    except requests.exceptions.RequestException as e:
+        if not has_snapshot:
+            raise
+        logger.warning(f"Nifty history download failed, serving the cached snapshot: {e}")
+        return pd.read_parquet(snapshot)
+    if response.status_code == 304 and has_snapshot:
+        return pd.read_parquet(snapshot)
+    response.raise_for_status()
+
+    df = _clean_history(_read_history_csv(io.BytesIO(response.content)))
+    etag = response.headers.get("ETag")
+    if etag:
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            partial = snapshot.with_suffix(".parquet.tmp")
+            df.to_parquet(partial)
+            os.replace(partial, snapshot) # Readers never see a half-written snapshot
+            etag_file.write_text(etag)
+        except OSError as e:
+            logger.warning(f"Could not write the Nifty history snapshot: {e}")
+    return df
+
+_history_load_lock = Lock()
+
+@cached(TTLCache(maxsize=4, ttl=3600), lock=Lock())
+def _load_nifty_history_cached(nifty_df_path: str):
+    """Reads and cleans one history source; see load_nifty_history."""
+    if nifty_df_path.endswith(".parquet"):
+        return _clean_history(pd.read_parquet(nifty_df_path, columns=["Date", "Close"]))
+    if nifty_df_path.startswith(("http://", "https://")):
+        return _fetch_remote_history(nifty_df_path)
+    return _clean_history(_read_history_csv(nifty_df_path))
+
+def load_nifty_history(nifty_df_path: str = settings.NIFTY_HISTORICAL_DATA_URL):
+    """Loads the historical Nifty data as a date-indexed, sorted 'Close' frame, cached for an hour.
+
+    Accepts the upstream CSV or a Parquet copy of it (any path ending in .parquet), which skips text
+    parsing and reads only the two needed columns. Remote CSVs are also kept as a Parquet snapshot on
+    disk, so restarts and hourly refreshes only re-download when the file has changed. The returned
+    frame is shared between callers and must not be modified in place. Concurrent cold requests share
+    a single load instead of each downloading and parsing the file.
+    """
+    with _history_load_lock:
+        return _load_nifty_history_cached(nifty_df_path)
+
+_model_session = requests.Session() # Pooled connection for model downloads
+_model_download_lock = Lock()
+
+@cached(TTLCache(maxsize=1, ttl=3600), lock=Lock())
+def _download_xgb_model(model_url: str):
+    """Downloads and unpickles the XGBoost model, unpickling straight off the socket rather than
+    buffering the whole body in memory first."""
+    with _model_session.get(model_url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True # Undo any gzip/deflate transfer encoding
+        return pickle.load(response.raw)
+
+def load_xgb_model(model_url: str = settings.XGBOOST_MODEL_URL):
+    """Returns the XGBoost volatility model, cached for an hour.
+
+    Concurrent cold requests share a single download instead of each fetching the model. Failed
+    downloads raise and are not cached, so the next request retries.
+    """
+    with _model_download_lock:
+        return _download_xgb_model(model_url)
+
 def compute_realized_vol(nifty_df_path: str = settings.NIFTY_HISTORICAL_DATA_URL):
     """Computes 7-day realized volatility from historical Nifty data."""
     try:
-        nifty_df = pd.read_csv(nifty_df_path)
-        nifty_df.columns = nifty_df.columns.str.strip()
-        nifty_df["Date"] = pd.to_datetime(nifty_df["Date"], format="%d-%b-%Y", errors="coerce")
-        nifty_df = nifty_df.dropna(subset=["Date"]).set_index("Date")
-        nifty_df = nifty_df.rename(columns={"Close": "NIFTY_Close"})
-        if 'NIFTY_Close' not in nifty_df.columns:
-            raise ValueError("CSV missing 'NIFTY_Close' column for realized volatility calculation.")
-        nifty_df = nifty_df[["NIFTY_Close"]].dropna().sort_index()
-
-        if nifty_df.empty or len(nifty_df) < 7:
-            logger.warning("Not enough data to compute 7-day realized volatility. Returning 0.")
-            return 0.0
+        closes = load_nifty_history(nifty_df_path)["Close"].dropna().to_numpy(dtype=np.float64)
 
-        log_returns = np.log(nifty_df["NIFTY_Close"].pct_change() + 1).dropna()
-        last_7d_log_returns = log_returns[-7:]
-
-        if last_7d_log_returns.empty:
+        if len(closes) < 7:
+            logger.warning("Not enough data to compute 7-day realized volatility. Returning 0.")
             return 0.0
 
-        last_7d_std = last_7d_log_returns.std()
-        realized_vol = last_7d_std * np.sqrt(252) * 100
-        return realized_vol if not np.isnan(realized_vol) else 0.0
+        # Only the last 7 log returns matter, so work on the last 8 closes rather than the whole series
+        last_7d_log_returns = np.diff(np.log(closes[-8:]))
+        realized_vol = last_7d_log_returns.std(ddof=1) * np.sqrt(252) * 100
+        return float(realized_vol) if not np.isnan(realized_vol) else 0.0
     except Exception as e:
         logger.error(f"Error computing realized volatility: {e}")
         return 0.0
@@ -43,44 +132,50 @@ def calculate_rolling_and_fixed_hv(df: pd.DataFrame, periods: list = [7, 30, 252
             raise ValueError("DataFrame must contain a 'Close' column for HV calculation.")
 
         results = {}
-        returns = np.log(df['Close'] / df['Close'].shift(1)).dropna()
+        # One log pass over the closes; returns touching a missing close are dropped, as before
+        returns = np.diff(np.log(df['Close'].to_numpy(dtype=np.float64)))
+        returns = returns[~np.isnan(returns)]
 
         for days in periods:
             if len(returns) < days:
                 results[f"hv_{days}d"] = 0.0
                 continue
-            vol = returns.rolling(window=days).std() * np.sqrt(252) * 100
-            results[f"hv_{days}d"] = round(vol.iloc[-1], 2) if not vol.empty else 0.0
+            # Only the latest window is reported, so take the std of the trailing returns instead of a full rolling pass
+            vol = returns[-days:].std(ddof=1) * np.sqrt(252) * 100
+            results[f"hv_{days}d"] = round(float(vol), 2)
         return results
     except Exception as e:
         logger.error(f"Historical volatility error: {e}")
         raise HTTPException(status_code=500, detail=f"Historical volatility calculation error: {str(e)}")
 
+# GARCH forecasts keyed by a digest of the return series and its last date; the history only changes
+# once a trading day, so same-day requests reuse the fitted forecast instead of re-running the MLE
+_garch_forecasts = TTLCache(maxsize=8, ttl=86400)
+_garch_lock = Lock() # Held across the fit so concurrent cold requests share one
+
 def predict_garch_model(nifty_df_path: str = settings.NIFTY_HISTORICAL_DATA_URL):
     """Predicts future volatility using a GARCH(1,1) model."""
     try:
-        df = pd.read_csv(nifty_df_path)
-        df.columns = df.columns.str.strip()
-        if 'Date' not in df.columns:
-            raise ValueError(f"CSV file does not contain 'Date' column. Available columns: {list(df.columns)}")
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce", format="%d-%b-%Y")
-        df = df.dropna(subset=["Date"]).set_index("Date").sort_index()
-        if 'Close' not in df.columns:
-            raise ValueError(f"CSV file does not contain 'Close' column. Available columns: {list(df.columns)}")
+        df = load_nifty_history(nifty_df_path) # Shared cached frame; read-only
         returns = np.log(df["Close"] / df["Close"].shift(1)).dropna() * 100
 
         if returns.empty or len(returns) < 10: # Ensure enough data for GARCH
             raise ValueError("Not enough historical data to fit GARCH model.")
 
-        model = arch_model(returns, vol="Garch", p=1, q=1)
-        result = model.fit(disp="off")
-        forecast = result.forecast(horizon=7)
-        vols = np.sqrt(forecast.variance.values[-1]) * np.sqrt(252)
-
         last_date = df.index[-1]
-        future_dates = pd.bdate_range(start=last_date + pd.Timedelta(days=1), periods=7)
+        key = (hashlib.blake2b(returns.to_numpy().tobytes(), digest_size=16).hexdigest(), last_date)
+        with _garch_lock:
+            forecast_results = _garch_forecasts.get(key)
+            if forecast_results is None:
+                model = arch_model(returns, vol="Garch", p=1, q=1)
+                result = model.fit(disp="off")
+                forecast = result.forecast(horizon=7)
+                vols = np.sqrt(forecast.variance.values[-1]) * np.sqrt(252)
 
-        return [{"date": str(d.date()), "forecast_volatility": round(v, 2)} for d, v in zip(future_dates, vols)]
+                future_dates = pd.bdate_range(start=last_date + pd.Timedelta(days=1), periods=7)
+                forecast_results = [{"date": str(d.date()), "forecast_volatility": round(v, 2)} for d, v in zip(future_dates, vols)]
+                _garch_forecasts[key] = forecast_results
+        return forecast_results
     except Exception as e:
         logger.error(f"GARCH prediction error: {e}")
         raise HTTPException(status_code=500, detail=f"GARCH prediction error: {str(e)}")